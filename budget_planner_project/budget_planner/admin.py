@@ -1,22 +1,161 @@
+import json
+
+from django import forms
 from django.contrib import admin
-from .models import Category, Transaction, BudgetGoal
+from django.http import FileResponse, Http404, QueryDict
+from django.template.response import TemplateResponse
+from .models import Category, Payee, Transaction, BudgetGoal, SpendingForecast, Tombstone, ShardAssignment
+from .payees import resolve_payee
+from .profiling import profile_path, recent_profiles
+from .sharding import shard_aliases
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shard_aliases()]
+
+    def choices(self, changelist):
+        # There is no "All": a changelist reads one database at a time.
+        for choice in list(super().choices(changelist))[1:]:
+            yield choice
+
+    def value(self):
+        return super().value() or shard_aliases()[0]
+
+    def queryset(self, request, queryset):
+        # ShardedModelAdmin.get_queryset already picked the database.
+        return queryset
+
+
+class ShardedModelAdmin(admin.ModelAdmin):
+    """Admin for per-user models; the shard filter picks the database to browse."""
+
+    def get_list_filter(self, request):
+        list_filter = super().get_list_filter(request)
+        if len(shard_aliases()) > 1:
+            list_filter = [ShardListFilter, *list_filter]
+        return list_filter
+
+    def get_list_select_related(self, request):
+        # Never join auth_user, which only exists on the default database.
+        if self.list_select_related is not False:
+            return self.list_select_related
+        return [
+            field.name for field in self.model._meta.get_fields()
+            if field.many_to_one and field.name != 'user' and field.name in self.list_display
+        ]
+
+    def get_queryset(self, request):
+        params = request.GET
+        # Change and delete pages carry the changelist's filters along.
+        if '_changelist_filters' in params:
+            params = QueryDict(params['_changelist_filters'])
+        shard = params.get(ShardListFilter.parameter_name)
+        queryset = super().get_queryset(request)
+        return queryset.using(shard) if shard in shard_aliases() else queryset
+
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(ShardedModelAdmin):
     list_display = ['name', 'type', 'user', 'created_at']
     list_filter = ['type', 'user']
     search_fields = ['name']
 
 
+@admin.register(Payee)
+class PayeeAdmin(ShardedModelAdmin):
+    list_display = ['name', 'user', 'created_at']
+    list_filter = ['user']
+    search_fields = ['name']
+
+
+class TransactionAdminForm(forms.ModelForm):
+    description = forms.CharField(max_length=255)
+
+    class Meta:
+        model = Transaction
+        fields = ['user', 'type', 'category', 'amount', 'description', 'date']
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.payee_id:
+            self.initial.setdefault('description', self.instance.description)
+
+
 @admin.register(Transaction)
-class TransactionAdmin(admin.ModelAdmin):
+class TransactionAdmin(ShardedModelAdmin):
+    form = TransactionAdminForm
     list_display = ['description', 'type', 'amount', 'category', 'date', 'user']
     list_filter = ['type', 'category', 'date', 'user']
-    search_fields = ['description']
+    list_select_related = ['payee', 'category']
+    search_fields = ['payee__name']
     date_hierarchy = 'date'
 
+    def save_model(self, request, obj, form, change):
+        # Saved inside the changeform's transaction, where a stale cached id
+        # would only fail at commit; look the payee up instead.
+        obj.payee = resolve_payee(obj.user, form.cleaned_data['description'], cached=False)
+        super().save_model(request, obj, form, change)
+
 
 @admin.register(BudgetGoal)
-class BudgetGoalAdmin(admin.ModelAdmin):
+class BudgetGoalAdmin(ShardedModelAdmin):
     list_display = ['category', 'amount', 'month', 'year', 'user']
     list_filter = ['month', 'year', 'user']
+
+
+@admin.register(SpendingForecast)
+class SpendingForecastAdmin(ShardedModelAdmin):
+    list_display = ['category', 'spent', 'projected_amount', 'month', 'year', 'user', 'computed_at']
+    list_filter = ['month', 'year', 'user']
+
+
+@admin.register(Tombstone)
+class TombstoneAdmin(ShardedModelAdmin):
+    list_display = ['model', 'object_id', 'deleted_at', 'user']
+    list_filter = ['model', 'user']
+
+
+@admin.register(ShardAssignment)
+class ShardAssignmentAdmin(admin.ModelAdmin):
+    list_display = ['user', 'shard', 'assigned_at']
+    list_filter = ['shard']
+    readonly_fields = ['shard']
+
+    def has_add_permission(self, request):
+        # Users get a shard on first use; move them with `manage.py rebalance_shards`.
+        return False
+
+
+def profile_list(request):
+    """Admin page listing the newest request profiles."""
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Request profiles',
+        'profiles': recent_profiles(),
+    }
+    return TemplateResponse(request, 'admin/profiles.html', context)
+
+
+def profile_detail(request, name):
+    path = profile_path(name, '.json')
+    if path is None:
+        raise Http404('No such profile')
+    profile = json.loads(path.read_text())
+    context = {
+        **admin.site.each_context(request),
+        'title': f'{profile["method"]} {profile["path"]}',
+        'profile': profile,
+        'has_dump': profile_path(name, '.prof') is not None,
+    }
+    return TemplateResponse(request, 'admin/profile_detail.html', context)
+
+
+def profile_download(request, name):
+    path = profile_path(name, '.prof')
+    if path is None:
+        raise Http404('No such profile')
+    return FileResponse(path.open('rb'), as_attachment=True, filename=path.name)
@@ -0,0 +1,140 @@
+"""In-memory columnar view of a user's transactions for report queries.
+
+A user's transactions are loaded once into parallel NumPy columns (date
+ordinal, month index, category id, payee id, expense flag, amount in integer
+cents). Group-by, pivot and rolling-window questions are then answered with
+vectorized operations instead of one ORM aggregate per bucket. Loaded frames
+are kept in a small LRU keyed by the user's change stamp, so any write to
+their data makes the next report reload it.
+"""
+import threading
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+
+from .models import Transaction
+from .stamps import get_change_stamp
+
+MAX_CACHED_FRAMES = 64
+
+# date.toordinal() of 1970-01-01, the NumPy datetime64 epoch.
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+# Category/payee id used for transactions without one.
+NONE_ID = -1
+
+
+def month_index(year, month):
+    """Months since 1970-01, the unit of the ``month`` column."""
+    return (year - 1970) * 12 + month - 1
+
+
+def month_start(index):
+    return date(1970 + index // 12, index % 12 + 1, 1)
+
+
+def cents_to_decimal(cents):
+    return Decimal(int(cents)) / 100
+
+
+class UserFrame:
+    def __init__(self, rows):
+        n = len(rows)
+        self.ordinal = np.fromiter((r[0].toordinal() for r in rows), dtype=np.int32, count=n)
+        self.category = np.fromiter(
+            (NONE_ID if r[1] is None else r[1] for r in rows), dtype=np.int64, count=n
+        )
+        self.payee = np.fromiter((r[2] for r in rows), dtype=np.int64, count=n)
+        self.expense = np.fromiter((r[3] == 'expense' for r in rows), dtype=bool, count=n)
+        self.cents = np.fromiter((int(r[4] * 100) for r in rows), dtype=np.int64, count=n)
+        days = (self.ordinal - EPOCH_ORDINAL).astype('datetime64[D]')
+        self.month = days.astype('datetime64[M]').astype(np.int32)
+        self.year = self.month // 12 + 1970
+
+    @classmethod
+    def load(cls, user):
+        return cls(list(
+            Transaction.objects.for_user(user).order_by()
+            .values_list('date', 'category_id', 'payee_id', 'type', 'amount')
+        ))
+
+    def __len__(self):
+        return len(self.cents)
+
+    def mask(self, start=None, end=None, type=None, year=None):
+        """Rows within ``[start, end]`` (dates), of one type and/or calendar year."""
+        selected = np.ones(len(self), dtype=bool)
+        if start is not None:
+            selected &= self.ordinal >= start.toordinal()
+        if end is not None:
+            selected &= self.ordinal <= end.toordinal()
+        if type == 'expense':
+            selected &= self.expense
+        elif type == 'income':
+            selected &= ~self.expense
+        if year is not None:
+            selected &= self.year == year
+        return selected
+
+    def values(self, measure='expense'):
+        """Per-row amount in cents: expense, income, or net (income positive)."""
+        if measure == 'expense':
+            return np.where(self.expense, self.cents, 0)
+        if measure == 'income':
+            return np.where(self.expense, 0, self.cents)
+        return np.where(self.expense, -self.cents, self.cents)
+
+    def total(self, mask, measure='expense'):
+        return int(self.values(measure)[mask].sum())
+
+    def group_by(self, key, mask, measure='expense'):
+        """Return ``(keys, totals)`` for one column, largest total first."""
+        column = getattr(self, key)[mask]
+        keys, inverse = np.unique(column, return_inverse=True)
+        totals = np.zeros(len(keys), dtype=np.int64)
+        np.add.at(totals, inverse, self.values(measure)[mask])
+        order = np.argsort(-totals, kind='stable')
+        return keys[order], totals[order]
+
+    def pivot(self, row_key, col_key, mask, measure='expense'):
+        """Return ``(row_keys, col_keys, matrix)`` of totals for two columns."""
+        rows, row_index = np.unique(getattr(self, row_key)[mask], return_inverse=True)
+        cols, col_index = np.unique(getattr(self, col_key)[mask], return_inverse=True)
+        matrix = np.zeros((len(rows), len(cols)), dtype=np.int64)
+        np.add.at(matrix, (row_index, col_index), self.values(measure)[mask])
+        return rows, cols, matrix
+
+    def rolling(self, start, end, window, mask, measure='expense'):
+        """Daily totals over ``[start, end]`` and their trailing ``window``-day sums."""
+        first = start.toordinal() - window + 1
+        days = end.toordinal() - first + 1
+        selected = mask & (self.ordinal >= first) & (self.ordinal <= end.toordinal())
+        daily = np.bincount(
+            self.ordinal[selected] - first, weights=self.values(measure)[selected], minlength=days
+        ).astype(np.int64)
+        cumulative = np.concatenate([[0], np.cumsum(daily)])
+        trailing = cumulative[window:] - cumulative[:-window]
+        return daily[window - 1:], trailing
+
+
+_frames = OrderedDict()
+_frames_lock = threading.Lock()
+
+
+def get_user_frame(user):
+    """Return the user's frame, reloading it only if their data changed."""
+    version = get_change_stamp(user).version
+    with _frames_lock:
+        cached = _frames.get(user.pk)
+        if cached is not None and cached[0] == version:
+            _frames.move_to_end(user.pk)
+            return cached[1]
+    frame = UserFrame.load(user)
+    with _frames_lock:
+        _frames[user.pk] = (version, frame)
+        _frames.move_to_end(user.pk)
+        while len(_frames) > MAX_CACHED_FRAMES:
+            _frames.popitem(last=False)
+    return frame
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class BudgetPlannerConfig(AppConfig):
     name = 'budget_planner'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,171 @@
+"""End-of-month spending projections for every (user, category) pair.
+
+Expense rows for the look-back window are pulled in a single ``values_list``
+pass and bucketed into NumPy arrays, so the projection for all pairs is
+computed in one batch instead of one ORM query per user and category.
+"""
+import calendar
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+from django.utils import timezone
+
+from .models import SpendingForecast, Transaction
+from .sharding import split_by_shard
+from .stamps import bump_change_stamp
+
+# Number of complete months before the current one used as history.
+LOOKBACK_MONTHS = 12
+
+# Lower bound for the historical "share of the month spent by today" so a
+# category that is usually paid late in the month does not explode the pace.
+MIN_TO_DATE_SHARE = 0.05
+
+BATCH_SIZE = 500
+
+
+def _shift_month(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def compute_forecasts(rows, today):
+    """Project end-of-month spend from ``(user_id, category_id, date, amount)`` rows.
+
+    Returns ``(pairs, spent, projected)`` where ``pairs`` is an ``(n, 2)`` array
+    of user/category ids and the other two are amounts in integer cents.
+    """
+    empty = np.empty((0, 2), dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    n = len(rows)
+    if not n:
+        return empty
+
+    users = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+    categories = np.fromiter((r[1] for r in rows), dtype=np.int64, count=n)
+    days = np.array([r[2] for r in rows], dtype='datetime64[D]')
+    cents = np.fromiter((int(r[3] * 100) for r in rows), dtype=np.int64, count=n)
+
+    months = days.astype('datetime64[M]')
+    day_of_month = (days - months).astype(np.int64) + 1
+    current_month = np.datetime64(today, 'M')
+    month_offset = (months - current_month).astype(np.int64) + LOOKBACK_MONTHS
+
+    pairs, pair_index = np.unique(np.stack([users, categories], axis=1), axis=0, return_inverse=True)
+    pair_index = pair_index.ravel()
+    shape = (len(pairs), LOOKBACK_MONTHS + 1)
+
+    totals = np.zeros(shape, dtype=np.int64)
+    np.add.at(totals, (pair_index, month_offset), cents)
+    to_date = np.zeros(shape, dtype=np.int64)
+    before = day_of_month <= today.day
+    np.add.at(to_date, (pair_index[before], month_offset[before]), cents[before])
+
+    spent = totals[:, -1]
+    history = totals[:, :-1]
+    history_to_date = to_date[:, :-1]
+
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    elapsed = today.day / days_in_month
+    run_rate = spent / elapsed
+
+    # Average month since the pair was first seen, and how this calendar month
+    # compared to that average a year ago.
+    active = history > 0
+    has_history = active.any(axis=1)
+    first_active = np.where(has_history, active.argmax(axis=1), LOOKBACK_MONTHS)
+    history_total = history.sum(axis=1)
+    mean_monthly = history_total / np.maximum(LOOKBACK_MONTHS - first_active, 1)
+    seasonal = np.where(
+        (first_active == 0) & (mean_monthly > 0),
+        history[:, 0] / np.where(mean_monthly > 0, mean_monthly, 1),
+        1.0,
+    )
+    baseline = mean_monthly * seasonal
+
+    # Historical share of a month's spend that lands by today's day of month.
+    share = np.clip(
+        history_to_date.sum(axis=1) / np.where(history_total > 0, history_total, 1),
+        MIN_TO_DATE_SHARE, 1.0,
+    )
+    pace = np.where(has_history, spent / share, run_rate)
+
+    projected = np.where(has_history, elapsed * pace + (1 - elapsed) * baseline, run_rate)
+    projected = np.maximum(np.rint(projected).astype(np.int64), spent)
+    return pairs, spent, projected
+
+
+def refresh_forecasts(user_ids=None, today=None):
+    """Recompute and store the current month's forecasts.
+
+    With ``user_ids`` only those users are refreshed; otherwise every user is
+    processed, one batch per database shard. Returns the number of forecasts
+    written.
+    """
+    today = today or timezone.localdate()
+    written = 0
+    for using, shard_user_ids in split_by_shard(user_ids).items():
+        written += _refresh_shard(using, shard_user_ids, today)
+        # Dashboard and goals pages show these, so let them revalidate.
+        bump_change_stamp(shard_user_ids, using=using)
+    return written
+
+
+def refresh_category_forecasts(user_id, category_ids, using, today=None):
+    """Recompute the current month's forecasts of some of one user's categories.
+
+    Meant for the transaction that wrote the user's expenses: it only reads
+    those categories' look-back window, and the write's own change stamp bump
+    covers the new forecasts.
+    """
+    return _refresh_shard(using, [user_id], today or timezone.localdate(), category_ids)
+
+
+def _refresh_shard(using, user_ids, today, category_ids=None):
+    started = timezone.now()
+    window_start = _shift_month(today, -LOOKBACK_MONTHS)
+
+    rows = Transaction.objects.using(using).filter(
+        type='expense', category__isnull=False,
+        date__gte=window_start, date__lte=today,
+    )
+    if user_ids is not None:
+        rows = rows.filter(user_id__in=user_ids)
+    if category_ids is not None:
+        rows = rows.filter(category_id__in=category_ids)
+    rows = list(rows.order_by().values_list('user_id', 'category_id', 'date', 'amount'))
+
+    pairs, spent, projected = compute_forecasts(rows, today)
+    forecasts = [
+        SpendingForecast(
+            user_id=int(user_id), category_id=int(category_id),
+            month=today.month, year=today.year,
+            spent=Decimal(int(s)) / 100, projected_amount=Decimal(int(p)) / 100,
+            computed_at=started,
+        )
+        for (user_id, category_id), s, p in zip(pairs, spent, projected)
+    ]
+    SpendingForecast.objects.using(using).bulk_create(
+        forecasts, batch_size=BATCH_SIZE, update_conflicts=True,
+        unique_fields=['user', 'category', 'month', 'year'],
+        update_fields=['spent', 'projected_amount', 'computed_at'],
+    )
+
+    # Pairs that dropped out of the window (e.g. the only expense was deleted).
+    stale = SpendingForecast.objects.using(using).filter(
+        month=today.month, year=today.year, computed_at__lt=started
+    )
+    if user_ids is not None:
+        stale = stale.filter(user_id__in=user_ids)
+    if category_ids is not None:
+        stale = stale.filter(category_id__in=category_ids)
+    stale.delete()
+    return len(forecasts)
+
+
+def forecasts_for(user, month, year):
+    """Map category id to the stored forecast for one user and month."""
+    return {
+        f.category_id: f
+        for f in SpendingForecast.objects.for_user(user).filter(month=month, year=year)
+    }
@@ -1,7 +1,15 @@
+from datetime import date, timedelta
+
 from django import forms
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.models import User
+from django.db import IntegrityError
+from django.db.transaction import atomic
+from django.utils import timezone
 from .models import Category, Transaction, BudgetGoal
+from .payees import resolve_payee
+from .registry import get_category_registry
+from .sharding import shard_for_user
 
 class RegisterForm(UserCreationForm):
     email = forms.EmailField(required=True)
@@ -60,7 +68,32 @@ class CategoryForm(forms.ModelForm):
         self.fields['color'].widget.attrs['class'] = 'form-select'
 
 
+class CategoryChoiceField(forms.ModelChoiceField):
+    """Category select backed by the user's cached registry instead of a queryset."""
+
+    def set_registry(self, registry, type=None):
+        self.registry = registry
+        choices = registry.choices(type)
+        if self.empty_label is not None:
+            choices = [('', self.empty_label)] + choices
+        self.choices = choices
+        self.allowed = {category.pk for category in registry.of_type(type)}
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            pk = int(value)
+        except (TypeError, ValueError):
+            pk = None
+        if pk not in self.allowed:
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return self.registry.get(pk)
+
+
 class TransactionForm(forms.ModelForm):
+    description = forms.CharField(max_length=255, widget=forms.TextInput(attrs={'class': 'form-control'}))
+
     class Meta:
         model = Transaction
         fields = ['type', 'category', 'amount', 'description', 'date']
@@ -68,13 +101,31 @@ class TransactionForm(forms.ModelForm):
             'type': forms.Select(attrs={'class': 'form-select', 'id': 'transaction-type'}),
             'category': forms.Select(attrs={'class': 'form-select'}),
             'amount': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01', 'min': '0'}),
-            'description': forms.TextInput(attrs={'class': 'form-control'}),
             'date': forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
         }
+        field_classes = {'category': CategoryChoiceField}
     
     def __init__(self, user, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['category'].queryset = Category.objects.filter(user=user)
+        self.user = user
+        self.fields['category'].set_registry(get_category_registry(user))
+        if self.instance.payee_id:
+            self.initial.setdefault('description', self.instance.description)
+
+    def save(self, commit=True):
+        self.instance.user = self.user
+        self.instance.payee = resolve_payee(self.user, self.cleaned_data['description'])
+        if not commit:
+            return super().save(commit)
+        pk, adding = self.instance.pk, self.instance._state.adding
+        try:
+            with atomic(using=shard_for_user(self.user)):
+                return super().save()
+        except IntegrityError:
+            # The cached payee id was stale: its row was rolled back or deleted.
+            self.instance.pk, self.instance._state.adding = pk, adding
+            self.instance.payee = resolve_payee(self.user, self.cleaned_data['description'], cached=False)
+            return super().save()
 
 
 class BudgetGoalForm(forms.ModelForm):
@@ -94,8 +145,81 @@ class BudgetGoalForm(forms.ModelForm):
             'amount': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01', 'min': '0'}),
             'year': forms.NumberInput(attrs={'class': 'form-control', 'min': '2020', 'max': '2030'}),
         }
+        field_classes = {'category': CategoryChoiceField}
     
     def __init__(self, user, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.fields['category'].queryset = Category.objects.filter(user=user, type='expense')
+        self.fields['category'].set_registry(get_category_registry(user), type='expense')
         self.fields['month'].widget.attrs['class'] = 'form-select'
+
+
+class BudgetPlanForm(forms.Form):
+    """One amount field per (expense category, month) of a year."""
+
+    def __init__(self, categories, goals, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.categories = categories
+        current = {(goal.category_id, goal.month): goal.amount for goal in goals}
+        for category in categories:
+            for month in range(1, 13):
+                self.fields[self.field_name(category.pk, month)] = forms.DecimalField(
+                    required=False, min_value=0, max_digits=12, decimal_places=2,
+                    initial=current.get((category.pk, month)),
+                    widget=forms.NumberInput(attrs={'class': 'form-control form-control-sm', 'step': '0.01', 'min': '0'}),
+                )
+
+    @staticmethod
+    def field_name(category_id, month):
+        return f'goal_{category_id}_{month}'
+
+    def rows(self):
+        """``(category, [bound field per month])`` for the template."""
+        return [
+            (category, [self[self.field_name(category.pk, month)] for month in range(1, 13)])
+            for category in self.categories
+        ]
+
+    def changes(self):
+        """Return ``(amounts, cleared)`` for the cells the user edited.
+
+        ``amounts`` maps ``(category_id, month)`` to a new or changed amount;
+        ``cleared`` lists the cells whose existing goal was emptied.
+        """
+        amounts, cleared = {}, []
+        for name in self.changed_data:
+            _, category_id, month = name.split('_')
+            key = (int(category_id), int(month))
+            if self.cleaned_data[name] is None:
+                cleared.append(key)
+            else:
+                amounts[key] = self.cleaned_data[name]
+        return amounts, cleared
+
+
+class ReportRangeForm(forms.Form):
+    """Date range and rolling window of the custom report; blank fields get defaults."""
+
+    # Analytics months count from 1970, and the report compares a year earlier.
+    MIN_DATE = date(1971, 1, 1)
+    MAX_SPAN = timedelta(days=5 * 366)
+    WINDOW_CHOICES = [(7, '7 days'), (30, '30 days'), (90, '90 days')]
+
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    window = forms.TypedChoiceField(choices=WINDOW_CHOICES, coerce=int, empty_value=30, required=False)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.errors:
+            return cleaned_data
+        today = timezone.localdate()
+        start = cleaned_data.get('start') or date(today.year - 1, today.month, 1)
+        end = cleaned_data.get('end') or today
+        if end < start:
+            start, end = end, start
+        if start < self.MIN_DATE:
+            raise forms.ValidationError(f'Reports start on {self.MIN_DATE:%b %d, %Y} at the earliest.')
+        if end - start > self.MAX_SPAN:
+            raise forms.ValidationError('Reports cover at most five years.')
+        cleaned_data['start'], cleaned_data['end'] = start, end
+        return cleaned_data
@@ -0,0 +1,329 @@
+"""Push dashboard updates to open browsers over Server-Sent Events.
+
+A stream opens with a snapshot of what the dashboard shows (month totals,
+goal progress, recent transactions). After that, each write to one of the
+user's transactions, goals or categories publishes a delta built from the
+saved row to an in-process broker, and the browser patches its copy. Deltas
+carry the write's change stamp version (the row's sync ``sequence``); a
+browser that sees a gap in the versions, or a ``resync`` event after a bulk
+write, reconnects for a fresh snapshot. ``EventStreamApp`` wraps the ASGI
+application and answers the event stream itself, before Django's request
+handling, so an open connection is one coroutine waiting on a queue rather
+than a thread.
+
+Live updates need the ASGI entry point (``uvicorn config.asgi:application``);
+under WSGI the URL answers 204 and the browser stops asking. The broker lives
+in the worker process, so a browser only hears about writes handled by the
+same process: run a single worker, or sticky sessions, when that matters.
+"""
+import asyncio
+import json
+import threading
+from contextlib import contextmanager
+from importlib import import_module
+from itertools import count
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.contrib.auth.models import User
+from django.db import close_old_connections, transaction
+from django.db.models import Sum
+from django.http import HttpRequest
+from django.http.cookie import parse_cookie
+from django.urls import reverse
+from django.utils import timezone
+
+from .forecasting import forecasts_for
+from .models import BudgetGoal, SpendingForecast, Transaction
+from .registry import get_category_registry
+from .sharding import shard_for_user
+from .stamps import get_change_stamp
+
+# A client whose queue overflows loses a delta, sees the gap in the
+# versions and reconnects for a snapshot.
+QUEUE_SIZE = 16
+
+# Comment lines keep proxies from closing an idle stream.
+KEEPALIVE_SECONDS = 15
+
+RETRY_MILLISECONDS = 5000
+
+RECENT_TRANSACTIONS = 5
+
+
+class Broker:
+    """Fan events for a user out to every stream that user has open."""
+
+    def __init__(self):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._ids = count(1)
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    @contextmanager
+    def subscribe(self, user_id):
+        """Register a queue for ``user_id`` on the running event loop."""
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(QUEUE_SIZE))
+        with self._lock:
+            self._subscribers.setdefault(user_id, set()).add(subscriber)
+        try:
+            yield subscriber[1]
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(user_id, set())
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    self._subscribers.pop(user_id, None)
+
+    def message(self, event, data):
+        return (next(self._ids), event, data)
+
+    def publish(self, user_id, event, data):
+        """Queue an event for the user's streams; safe to call from any thread."""
+        message = self.message(event, data)
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, message)
+
+
+def _offer(queue, message):
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+broker = Broker()
+
+
+def _progress(spent, amount):
+    return float(min(round(spent / amount * 100, 1), 100)) if amount > 0 else 0
+
+
+def _goal_data(goal, category_name, spent, forecast):
+    return {
+        'id': goal.pk,
+        'category_id': goal.category_id,
+        'category': category_name,
+        'spent': float(spent),
+        'amount': float(goal.amount),
+        'progress': _progress(spent, goal.amount),
+        'projected': float(forecast.projected_amount) if forecast else None,
+    }
+
+
+def _transaction_data(t, icon):
+    return {
+        'id': t.pk,
+        'category_id': t.category_id,
+        'type': t.type,
+        'amount': float(t.amount),
+        'description': t.description,
+        'date': t.date.isoformat(),
+        'icon': icon,
+    }
+
+
+def dashboard_snapshot(user):
+    """The live parts of the dashboard for the current month, JSON-ready."""
+    today = timezone.now()
+    # Read first: a write landing meanwhile then shows up as a delta too.
+    version = get_change_stamp(user).version
+    month = Transaction.objects.for_user(user).filter(date__month=today.month, date__year=today.year)
+    totals = dict(month.order_by().values_list('type').annotate(total=Sum('amount')))
+    income = totals.get('income') or 0
+    expense = totals.get('expense') or 0
+    spent = dict(
+        month.filter(type='expense').order_by()
+        .values_list('category_id').annotate(total=Sum('amount'))
+    )
+
+    registry = get_category_registry(user)
+    forecasts = forecasts_for(user, today.month, today.year)
+    goals = []
+    for goal in BudgetGoal.objects.for_user(user).filter(month=today.month, year=today.year):
+        category = registry.get(goal.category_id)
+        goals.append(_goal_data(
+            goal, category.name if category else '', spent.get(goal.category_id) or 0, forecasts.get(goal.category_id)
+        ))
+
+    recent = []
+    for t in Transaction.objects.for_user(user).select_related('payee')[:RECENT_TRANSACTIONS]:
+        category = registry.get(t.category_id)
+        recent.append(_transaction_data(t, category.icon if category else 'bi-tag'))
+
+    return {
+        'version': version,
+        'month': f'{today:%Y-%m}',
+        'recent_limit': RECENT_TRANSACTIONS,
+        'monthly_income': float(income),
+        'monthly_expense': float(expense),
+        'balance': float(income - expense),
+        'goals': goals,
+        'recent': recent,
+    }
+
+
+def transaction_delta(t, previous, deleted):
+    """A saved or deleted transaction, and the fields it had before, as a delta.
+
+    Build it when the signal fires: a deleted row loses its id afterwards.
+    """
+    if deleted:
+        previous = {'type': t.type, 'amount': t.amount, 'date': t.date, 'category_id': t.category_id}
+    return {
+        'version': t.sequence,
+        'id': t.pk,
+        'transaction': None if deleted else _transaction_data(t, t.category.icon if t.category else 'bi-tag'),
+        'previous': previous and {
+            'type': previous['type'],
+            'amount': float(previous['amount']),
+            'date': previous['date'].isoformat(),
+            'category_id': previous['category_id'],
+        },
+    }
+
+
+def goal_delta(goal, deleted):
+    # ``publish_delta`` fills in a saved goal; ``None`` takes it off the dashboard.
+    return {'version': goal.sequence, 'id': goal.pk, 'goal': None if deleted else {}}
+
+
+def _current_goal_data(user, goal_id, today):
+    """The goal as the dashboard shows it, or ``None`` if it is for another month."""
+    goal = BudgetGoal.objects.for_user(user).filter(
+        pk=goal_id, month=today.month, year=today.year,
+    ).select_related('category').first()
+    if goal is None:
+        return None
+    spent = Transaction.objects.for_user(user).filter(
+        type='expense', category_id=goal.category_id, date__month=today.month, date__year=today.year,
+    ).aggregate(total=Sum('amount'))['total'] or 0
+    forecast = SpendingForecast.objects.for_user(user).filter(
+        category_id=goal.category_id, month=today.month, year=today.year,
+    ).first()
+    return _goal_data(goal, goal.category.name, spent, forecast)
+
+
+def category_delta(category):
+    return {'version': category.sequence, 'id': category.pk, 'name': category.name, 'icon': category.icon}
+
+
+def publish_delta(user_id, event, delta):
+    """Send one write's delta, with the figures derived from it, once it has committed."""
+    if not broker.has_subscribers(user_id):
+        return
+    user = User(pk=user_id)
+    today = timezone.now()
+    if event == 'transaction':
+        # The write refreshed these categories' forecasts (``signals.transaction_saved``).
+        category_ids = {
+            row['category_id'] for row in [delta['transaction'], delta['previous']] if row and row['category_id']
+        }
+        forecasts = forecasts_for(user, today.month, today.year) if category_ids else {}
+        delta['projected'] = {
+            category_id: float(forecasts[category_id].projected_amount) if category_id in forecasts else None
+            for category_id in category_ids
+        }
+    elif event == 'goal' and delta['goal'] is not None:
+        delta['goal'] = _current_goal_data(user, delta['id'], today)
+    broker.publish(user_id, event, delta)
+
+
+def publish_resync(user_id):
+    """Ask the user's dashboards to reload their snapshot, after writes with no delta."""
+    if broker.has_subscribers(user_id):
+        broker.publish(user_id, 'resync', {})
+
+
+def _format_event(message):
+    event_id, event, data = message
+    return f'id: {event_id}\nevent: {event}\ndata: {json.dumps(data)}\n\n'.encode()
+
+
+def _authenticate(headers):
+    """Return the id of the user logged in with the request's session cookie."""
+    try:
+        cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+        request = HttpRequest()
+        request.session = import_module(settings.SESSION_ENGINE).SessionStore(
+            cookies.get(settings.SESSION_COOKIE_NAME)
+        )
+        user = get_user(request)
+        return user.pk if user.is_authenticated else None
+    finally:
+        close_old_connections()
+
+
+def _snapshot_for(user_id):
+    user = User(pk=user_id)
+    try:
+        # One transaction, so the version matches the rows read (on SQLite,
+        # or with repeatable reads).
+        with transaction.atomic(using=shard_for_user(user)):
+            return dashboard_snapshot(user)
+    finally:
+        close_old_connections()
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class EventStreamApp:
+    """ASGI middleware serving the dashboard event stream; other requests pass through."""
+
+    def __init__(self, application):
+        self.application = application
+        self._path = None
+
+    async def __call__(self, scope, receive, send):
+        if self._path is None:
+            self._path = reverse('dashboard_events')
+        if scope['type'] != 'http' or scope['path'] != self._path or scope['method'] != 'GET':
+            return await self.application(scope, receive, send)
+
+        headers = dict(scope['headers'])
+        user_id = await sync_to_async(_authenticate, thread_sensitive=False)(headers)
+        if user_id is None:
+            await send({'type': 'http.response.start', 'status': 401, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+        try:
+            with broker.subscribe(user_id) as queue:
+                await self._stream(send, queue, disconnected, user_id)
+        finally:
+            disconnected.cancel()
+
+    async def _stream(self, send, queue, disconnected, user_id):
+        # Subscribed already, so deltas for writes after the snapshot follow it.
+        snapshot = await sync_to_async(_snapshot_for, thread_sensitive=False)(user_id)
+        body = f'retry: {RETRY_MILLISECONDS}\n\n'.encode() + _format_event(broker.message('dashboard', snapshot))
+        await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {getter, disconnected}, timeout=KEEPALIVE_SECONDS, return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter not in done:
+                getter.cancel()
+            if disconnected in done:
+                return
+            body = _format_event(getter.result()) if getter in done else b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
@@ -0,0 +1,82 @@
+"""Structured, non-blocking logging.
+
+Request threads only put records on an in-memory queue; a listener thread
+formats them as JSON and writes them through the configured (rotating)
+handlers. ``RequestContextMiddleware`` stores the current request so every
+record carries its request id and user id.
+"""
+import contextvars
+import copy
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        request = current_request.get()
+        record.request_id = getattr(request, 'id', None)
+        user = getattr(request, 'user', None)
+        record.user_id = user.pk if user is not None and user.is_authenticated else None
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'user_id': getattr(record, 'user_id', None),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class StructuredQueueHandler(QueueHandler):
+    listener = None
+
+    def close(self):
+        # logging.shutdown() closes this before the handlers it feeds, so the
+        # queue is drained into them on exit.
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+        super().close()
+
+    def prepare(self, record):
+        # Resolve everything that must not outlive the request thread (args,
+        # tracebacks, the request object) but leave formatting to the listener.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.__dict__.pop('request', None)
+        return record
+
+
+def queue_listener_handler(handlers, respect_handler_level=True):
+    """``dictConfig`` factory: a queue handler feeding a listener thread.
+
+    ``handlers`` are references to other configured handlers, e.g.
+    ``['cfg://handlers.file']``; they must sort before this handler's name.
+    """
+    # Index access lets dictConfig resolve the cfg:// references.
+    targets = [handlers[i] for i in range(len(handlers))]
+    for target in targets:
+        if not isinstance(target, logging.Handler):
+            raise ValueError(f'{target!r} is not a configured handler')
+    handler = StructuredQueueHandler(queue.SimpleQueue())
+    handler.listener = QueueListener(handler.queue, *targets, respect_handler_level=respect_handler_level)
+    handler.listener.start()
+    return handler
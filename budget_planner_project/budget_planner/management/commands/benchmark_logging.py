@@ -0,0 +1,77 @@
+import logging
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from budget_planner import views
+from budget_planner.log import JSONFormatter, RequestContextFilter, queue_listener_handler
+
+
+class Command(BaseCommand):
+    help = 'Compare request latency of synchronous vs queued logging under a burst of contact form errors'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--threads', type=int, default=8)
+
+    def handle(self, *args, **options):
+        factory = RequestFactory()
+        data = {'name': 'Bench', 'email': 'bench@example.com', 'subject': 'Load', 'message': 'x' * 200}
+
+        def post_contact(_):
+            request = factory.post('/contact/', data)
+            request.user = AnonymousUser()
+            request.session = SessionStore()
+            request._messages = FallbackStorage(request)
+            start = time.perf_counter()
+            views.contact(request)
+            return time.perf_counter() - start
+
+        logger = logging.getLogger('budget_planner')
+        original_handlers = logger.handlers[:]
+        rows = []
+
+        # Warm up template loading so it doesn't count against the first mode.
+        logger.handlers = [logging.NullHandler()]
+        with override_settings(EMAIL_HOST_PASSWORD='your-app-password-here'):
+            post_contact(None)
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                override_settings(EMAIL_HOST_PASSWORD='your-app-password-here'):
+            for mode in ['sync', 'queue']:
+                file_handler = RotatingFileHandler(
+                    Path(tmp) / f'{mode}.log', maxBytes=10 * 1024 * 1024, backupCount=2
+                )
+                file_handler.setFormatter(JSONFormatter())
+                if mode == 'sync':
+                    handler = file_handler
+                else:
+                    handler = queue_listener_handler([file_handler])
+                handler.addFilter(RequestContextFilter())
+                logger.handlers = [handler]
+                try:
+                    with ThreadPoolExecutor(options['threads']) as pool:
+                        latencies = sorted(pool.map(post_contact, range(options['requests'])))
+                finally:
+                    handler.close()
+                    file_handler.close()
+                rows.append((mode, latencies))
+        logger.handlers = original_handlers
+
+        self.stdout.write(f"{'mode':<6} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for mode, latencies in rows:
+            p95 = latencies[int(len(latencies) * 0.95) - 1]
+            self.stdout.write(
+                f'{mode:<6} {statistics.mean(latencies) * 1000:>9.3f} {statistics.median(latencies) * 1000:>9.3f} '
+                f'{p95 * 1000:>9.3f} {latencies[-1] * 1000:>9.3f}'
+            )
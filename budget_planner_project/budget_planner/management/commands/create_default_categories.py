@@ -31,7 +31,7 @@ class Command(BaseCommand):
         for user in users:
             self.stdout.write(f'Processing user: {user.username}')
             for cat in default_categories:
-                category, created = Category.objects.get_or_create(
+                category, created = Category.objects.shard(user).get_or_create(
                     user=user,
                     name=cat['name'],
                     defaults={
@@ -0,0 +1,13 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from budget_planner.sharding import shard_aliases
+
+
+class Command(BaseCommand):
+    help = 'Run migrate on every database shard (default included)'
+
+    def handle(self, *args, **options):
+        for alias in shard_aliases():
+            self.stdout.write(f'Migrating {alias}')
+            call_command('migrate', database=alias, verbosity=options['verbosity'], interactive=False)
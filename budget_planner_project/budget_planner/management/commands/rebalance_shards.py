@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from budget_planner.rebalancing import (
+    MOVE_BATCH_SIZE, MOVE_DRAIN_SECONDS, ShardMoveConflict, move_user, rebalance_plan,
+)
+from budget_planner.sharding import shard_aliases, shard_for_user, shard_loads
+
+
+class Command(BaseCommand):
+    help = 'Move users between database shards, either explicitly or to even out users per shard'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Move this user id (may be repeated); requires --to')
+        parser.add_argument('--to', dest='target', help='Shard alias to move --user to')
+        parser.add_argument('--batch-size', type=int, default=MOVE_BATCH_SIZE)
+        parser.add_argument('--drain', type=float, default=MOVE_DRAIN_SECONDS,
+                            help='Seconds to let in-flight writes finish before copying a user')
+        parser.add_argument('--dry-run', action='store_true', help='Only print the planned moves')
+
+    def handle(self, *args, **options):
+        if options['user_ids']:
+            target = options['target']
+            if target not in shard_aliases():
+                raise CommandError(f'--to must be one of: {", ".join(shard_aliases())}')
+            moves = [(user_id, shard_for_user(user_id), target) for user_id in options['user_ids']]
+        else:
+            moves = rebalance_plan()
+
+        if not moves:
+            self.stdout.write('Shards are balanced: ' + ', '.join(f'{a}={n}' for a, n in shard_loads().items()))
+            return
+
+        failed = 0
+        for user_id, source, target in moves:
+            if options['dry_run']:
+                self.stdout.write(f'Would move user {user_id}: {source} -> {target}')
+                continue
+            try:
+                copied = move_user(user_id, target, batch_size=options['batch_size'], drain=options['drain'])
+            except ShardMoveConflict as e:
+                failed += 1
+                self.stderr.write(str(e))
+                continue
+            self.stdout.write(f'Moved user {user_id}: {source} -> {target} ({copied} rows)')
+
+        if failed:
+            raise CommandError(f'{failed} move(s) failed; run the command again')
+        if not options['dry_run']:
+            self.stdout.write(self.style.SUCCESS(
+                'Users per shard: ' + ', '.join(f'{a}={n}' for a, n in shard_loads().items())
+            ))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from budget_planner.forecasting import refresh_forecasts
+
+
+class Command(BaseCommand):
+    help = 'Recompute end-of-month spending forecasts (run daily so run-rates follow the calendar)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only refresh this user id (may be repeated)')
+
+    def handle(self, *args, **options):
+        count = refresh_forecasts(options['user_ids'])
+        self.stdout.write(self.style.SUCCESS(f'Refreshed {count} forecasts'))
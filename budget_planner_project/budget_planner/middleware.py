@@ -0,0 +1,53 @@
+import re
+import uuid
+
+from django.http import HttpResponse
+
+from .log import current_request
+from .sharding import ShardMoveInProgress
+
+REQUEST_ID_RE = re.compile(r'^[\w.-]{1,64}$')
+
+
+class RequestContextMiddleware:
+    """Tag each request with an id and expose it to logging.
+
+    A well-formed incoming ``X-Request-ID`` is reused so ids line up with a
+    proxy's logs; otherwise a new one is generated. The id is echoed back on
+    the response.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_id = request.headers.get('X-Request-ID', '')
+        request.id = request_id if REQUEST_ID_RE.match(request_id) else uuid.uuid4().hex
+        token = current_request.set(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        response['X-Request-ID'] = request.id
+        return response
+
+
+class ShardMoveMiddleware:
+    """Answer writes refused during a shard move with 503 and ``Retry-After``."""
+
+    RETRY_AFTER = 5
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, ShardMoveInProgress):
+            response = HttpResponse(
+                'Your budget data is being moved. Please try again in a few seconds.',
+                status=503, content_type='text/plain',
+            )
+            response['Retry-After'] = str(self.RETRY_AFTER)
+            return response
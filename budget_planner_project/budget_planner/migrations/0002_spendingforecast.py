@@ -0,0 +1,34 @@
+# Generated by Django 4.2.5 on 2026-10-19 15:51
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('budget_planner', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpendingForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.IntegerField()),
+                ('year', models.IntegerField()),
+                ('spent', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('projected_amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('computed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='budget_planner.category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-year', '-month'],
+                'unique_together': {('user', 'category', 'month', 'year')},
+            },
+        ),
+    ]
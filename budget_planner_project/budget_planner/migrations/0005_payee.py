@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+
+def normalize(name):
+    return ' '.join(name.split())
+
+
+def backfill_payees(apps, schema_editor):
+    """Point every transaction at a Payee for its description, in pk batches."""
+    Payee = apps.get_model('budget_planner', 'Payee')
+    Transaction = apps.get_model('budget_planner', 'Transaction')
+    db = schema_editor.connection.alias
+    payee_ids = {}
+    last_pk = 0
+    while True:
+        batch = list(
+            Transaction.objects.using(db).filter(pk__gt=last_pk).order_by('pk')
+            .only('pk', 'user_id', 'description')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        missing = {(t.user_id, normalize(t.description)) for t in batch} - payee_ids.keys()
+        if missing:
+            Payee.objects.using(db).bulk_create(
+                [Payee(user_id=user_id, name=name) for user_id, name in missing],
+                ignore_conflicts=True,
+            )
+            for user_id in {user_id for user_id, _ in missing}:
+                names = [name for uid, name in missing if uid == user_id]
+                for pk, name in Payee.objects.using(db).filter(user_id=user_id, name__in=names).values_list('pk', 'name'):
+                    payee_ids[user_id, name] = pk
+        for t in batch:
+            t.payee_id = payee_ids[t.user_id, normalize(t.description)]
+        Transaction.objects.using(db).bulk_update(batch, ['payee'])
+        last_pk = batch[-1].pk
+
+
+def restore_descriptions(apps, schema_editor):
+    Transaction = apps.get_model('budget_planner', 'Transaction')
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        batch = list(
+            Transaction.objects.using(db).filter(pk__gt=last_pk).order_by('pk')
+            .select_related('payee')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        for t in batch:
+            t.description = t.payee.name if t.payee_id else ''
+        Transaction.objects.using(db).bulk_update(batch, ['description'])
+        last_pk = batch[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('budget_planner', '0004_changestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Payee',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['name'],
+                'unique_together': {('user', 'name')},
+            },
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='payee',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.RESTRICT, to='budget_planner.payee'),
+        ),
+        migrations.RunPython(backfill_payees, restore_descriptions),
+    ]
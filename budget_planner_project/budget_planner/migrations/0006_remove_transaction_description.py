@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget_planner', '0005_payee'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='payee',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, to='budget_planner.payee'),
+        ),
+        # Gives the column a default so unapplying can re-add it to existing rows.
+        migrations.AlterField(
+            model_name='transaction',
+            name='description',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='description',
+        ),
+    ]
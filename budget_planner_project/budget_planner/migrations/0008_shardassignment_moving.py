@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-19 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget_planner', '0007_sharding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shardassignment',
+            name='moving',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.5 on 2026-10-19 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('budget_planner', '0008_shardassignment_moving'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='budgetgoal',
+            name='budget_plan_user_id_5cbd0a_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='category',
+            name='budget_plan_user_id_746a2c_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='tombstone',
+            name='budget_plan_user_id_ff1d1c_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='budget_plan_user_id_3343dd_idx',
+        ),
+        migrations.AddField(
+            model_name='budgetgoal',
+            name='sequence',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='sequence',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='tombstone',
+            name='sequence',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='sequence',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='budgetgoal',
+            index=models.Index(fields=['user', 'sequence', 'id'], name='budget_plan_user_id_268ca5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='category',
+            index=models.Index(fields=['user', 'sequence', 'id'], name='budget_plan_user_id_1e1c11_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tombstone',
+            index=models.Index(fields=['user', 'sequence', 'id'], name='budget_plan_user_id_1bfb9e_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user', 'sequence', 'id'], name='budget_plan_user_id_7cb306_idx'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, migrations
+
+BATCH_SIZE = 1000
+
+
+def assign_existing_users(apps, schema_editor):
+    """Pin every user without an assignment to ``default``, where their rows are.
+
+    Single-database installs never record assignments; without this, turning
+    on ``DB_SHARDS`` would place existing users on shards holding none of
+    their data.
+    """
+    if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+        return
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    ShardAssignment = apps.get_model('budget_planner', 'ShardAssignment')
+    unassigned = User.objects.filter(shardassignment__isnull=True).order_by('pk').values_list('pk', flat=True)
+    while True:
+        user_ids = list(unassigned[:BATCH_SIZE])
+        if not user_ids:
+            break
+        ShardAssignment.objects.bulk_create(
+            [ShardAssignment(user_id=user_id, shard=DEFAULT_DB_ALIAS) for user_id in user_ids],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('budget_planner', '0009_sync_sequence'),
+    ]
+
+    operations = [
+        migrations.RunPython(assign_existing_users, migrations.RunPython.noop),
+    ]
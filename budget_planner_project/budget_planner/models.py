@@ -1,8 +1,113 @@
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.utils import timezone
+from .sharding import check_writable, shard_for_user
 
-class Category(models.Model):
+
+class UserDataQuerySet(models.QuerySet):
+    """Queries for per-user models, which live on the user's database shard.
+
+    Set-based writes through ``shard()``/``for_user()``, which send no model
+    signals, are refused while the user's data is being moved to another
+    shard; ``signals`` does the same for saves and deletes. On synced models
+    they also give the rows written a new ``sequence``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._shard_user_id = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._shard_user_id = self._shard_user_id
+        return clone
+
+    def shard(self, user):
+        queryset = self.using(shard_for_user(user))
+        queryset._shard_user_id = user.pk if isinstance(user, User) else user
+        return queryset
+
+    def for_user(self, user):
+        return self.shard(user).filter(user=user)
+
+    def _check_writable(self):
+        if self._shard_user_id is not None:
+            check_writable(self._shard_user_id, self.db)
+
+    def _sequenced(self):
+        return self._shard_user_id is not None and issubclass(self.model, SyncedModel)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        self._check_writable()
+        if not self._sequenced():
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        if kwargs.get('update_fields'):
+            kwargs['update_fields'] = [*kwargs['update_fields'], 'sequence']
+        with transaction.atomic(using=self.db, savepoint=False):
+            sequence = next_sequence(self._shard_user_id, self.db)
+            for obj in objs:
+                obj.sequence = sequence
+            return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        self._check_writable()
+        if not self._sequenced():
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            sequence = next_sequence(self._shard_user_id, self.db)
+            for obj in objs:
+                obj.sequence = sequence
+            return super().bulk_update(objs, [*fields, 'sequence'], *args, **kwargs)
+
+    def update(self, **kwargs):
+        self._check_writable()
+        if not self._sequenced():
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            kwargs['sequence'] = next_sequence(self._shard_user_id, self.db)
+            return super().update(**kwargs)
+
+    def delete(self):
+        with transaction.atomic(using=self.db, savepoint=False):
+            deleted = super().delete()
+            write_pending_tombstones(self)
+        return deleted
+
+
+class SyncedModel(models.Model):
+    """Per-user rows that offline clients sync (see ``sync``).
+
+    Every write gives the row the user's next change stamp version as its
+    ``sequence``, in the same transaction, so a client that has seen up to
+    some sequence has seen every row written before it: unlike a timestamp
+    taken before the commit, a sequence cannot commit out of order.
+    """
+    sequence = models.BigIntegerField(default=0, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = [*kwargs['update_fields'], 'sequence']
+        with transaction.atomic(using=using, savepoint=False):
+            self.sequence = next_sequence(self.user_id, using)
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+        with transaction.atomic(using=using, savepoint=False):
+            deleted = super().delete(*args, **kwargs)
+            # Rows that went with this one (a category's goals).
+            write_pending_tombstones(self)
+        return deleted
+
+
+class Category(SyncedModel):
     CATEGORY_TYPES = [
         ('income', 'Income'),
         ('expense', 'Expense'),
@@ -12,57 +117,89 @@ class Category(models.Model):
     type = models.CharField(max_length=10, choices=CATEGORY_TYPES)
     icon = models.CharField(max_length=50, default='bi-tag')
     color = models.CharField(max_length=20, default='primary')
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserDataQuerySet.as_manager()
     
     class Meta:
         verbose_name_plural = 'Categories'
         ordering = ['name']
+        indexes = [models.Index(fields=['user', 'sequence', 'id'])]
     
     def __str__(self):
         return f"{self.name} ({self.type})"
 
 
-class Transaction(models.Model):
+class Payee(models.Model):
+    """Interned transaction description ("Uber", "Rent", ...) shared by a user's rows."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    name = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = UserDataQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['user', 'name']
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+class Transaction(SyncedModel):
     TRANSACTION_TYPES = [
         ('income', 'Income'),
         ('expense', 'Expense'),
     ]
     
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True)
     type = models.CharField(max_length=10, choices=TRANSACTION_TYPES)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
-    description = models.CharField(max_length=255)
+    payee = models.ForeignKey(Payee, on_delete=models.RESTRICT)
     date = models.DateField(default=timezone.now)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserDataQuerySet.as_manager()
     
     class Meta:
         ordering = ['-date', '-created_at']
+        indexes = [models.Index(fields=['user', 'sequence', 'id'])]
     
     def __str__(self):
         return f"{self.type}: {self.amount} - {self.description}"
 
+    @property
+    def description(self):
+        return self.payee.name
+
 
-class BudgetGoal(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+class BudgetGoal(SyncedModel):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     month = models.IntegerField()
     year = models.IntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = UserDataQuerySet.as_manager()
     
     class Meta:
         unique_together = ['user', 'category', 'month', 'year']
         ordering = ['-year', '-month']
+        indexes = [models.Index(fields=['user', 'sequence', 'id'])]
     
     def __str__(self):
         return f"{self.category.name}: {self.amount} ({self.month}/{self.year})"
     
     def get_spent(self):
         from django.db.models import Sum
-        spent = Transaction.objects.filter(
-            user=self.user,
+        spent = Transaction.objects.using(self._state.db).filter(
+            user_id=self.user_id,
             category=self.category,
             type='expense',
             date__month=self.month,
@@ -75,3 +212,100 @@ class BudgetGoal(models.Model):
         if self.amount > 0:
             return min(round((spent / self.amount) * 100, 1), 100)
         return 0
+
+
+class SpendingForecast(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    month = models.IntegerField()
+    year = models.IntegerField()
+    spent = models.DecimalField(max_digits=12, decimal_places=2)
+    projected_amount = models.DecimalField(max_digits=12, decimal_places=2)
+    computed_at = models.DateTimeField(default=timezone.now)
+
+    objects = UserDataQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ['user', 'category', 'month', 'year']
+        ordering = ['-year', '-month']
+
+    def __str__(self):
+        return f"{self.category.name}: {self.projected_amount} projected ({self.month}/{self.year})"
+
+
+class Tombstone(SyncedModel):
+    """Record of a deleted row so sync clients can drop their copy."""
+    MODEL_TYPES = [
+        ('transaction', 'Transaction'),
+        ('category', 'Category'),
+        ('budget_goal', 'Budget Goal'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
+    model = models.CharField(max_length=20, choices=MODEL_TYPES)
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    objects = UserDataQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['deleted_at']
+        indexes = [models.Index(fields=['user', 'sequence', 'id'])]
+
+    def __str__(self):
+        return f"{self.model} #{self.object_id} deleted {self.deleted_at}"
+
+
+class ChangeStamp(models.Model):
+    """Per-user version bumped on every write to the user's budget data."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, db_constraint=False)
+    version = models.BigIntegerField(default=0)
+    changed_at = models.DateTimeField(default=timezone.now)
+
+    objects = UserDataQuerySet.as_manager()
+
+    def __str__(self):
+        return f"{self.user} v{self.version}"
+
+
+def write_pending_tombstones(origin):
+    """Write the tombstones a set-based or cascading delete collected, one batch per user.
+
+    ``signals.record_tombstone`` collects them on the delete's origin (the
+    queryset or the instance whose delete cascaded), so a delete of many rows
+    takes one sequence and one INSERT instead of a few queries per row.
+    """
+    pending = origin.__dict__.pop('_pending_tombstones', None)
+    if not pending:
+        return
+    by_user = {}
+    for tombstone in pending:
+        by_user.setdefault(tombstone.user_id, []).append(tombstone)
+    for user_id, tombstones in by_user.items():
+        Tombstone.objects.shard(user_id).bulk_create(tombstones)
+
+
+def next_sequence(user_id, using):
+    """Bump the user's change stamp and return its new version.
+
+    Call it inside the transaction writing the rows that get the version: on
+    databases with row locks the stamp stays locked until that commits, so a
+    user's writes commit in sequence order.
+    """
+    stamps = ChangeStamp.objects.using(using).filter(user_id=user_id)
+    if not stamps.update(version=F('version') + 1, changed_at=timezone.now()):
+        ChangeStamp.objects.using(using).get_or_create(user_id=user_id)
+        stamps.update(version=F('version') + 1, changed_at=timezone.now())
+    return stamps.values_list('version', flat=True).get()
+
+
+class ShardAssignment(models.Model):
+    """Which database shard holds a user's budget data; always on ``default``."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    shard = models.CharField(max_length=50, db_index=True)
+    assigned_at = models.DateTimeField(auto_now=True)
+    # Set while ``rebalancing.move_user`` copies the user's data; writes are refused.
+    moving = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.user} on {self.shard}"
@@ -0,0 +1,54 @@
+"""Resolve free-text transaction descriptions to interned ``Payee`` rows.
+
+The same few hundred payees make up most of a user's transactions, so the
+name -> id mapping is cached and entry forms normally resolve a payee
+without touching the database. Ids are only cached once the payee row is
+committed, and are dropped when it is deleted; a save that still trips over
+a stale id retries with ``cached=False``.
+"""
+import hashlib
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Payee
+from .sharding import user_placement
+
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def normalize_payee_name(name):
+    return ' '.join(name.split())
+
+
+def _cache_key(user, name):
+    # Ids are per database: a moved user's payees get new ones.
+    shard, assigned_at = user_placement(user)
+    epoch = assigned_at.timestamp() if assigned_at else 0
+    digest = hashlib.sha1(name.encode()).hexdigest()
+    user_id = user.pk if isinstance(user, User) else user
+    return f'payee:{shard}:{epoch}:{user_id}:{digest}'
+
+
+def resolve_payee(user, name, cached=True):
+    """Return the user's payee called ``name``, creating it on first use."""
+    name = normalize_payee_name(name)
+    key = _cache_key(user, name)
+    payee_id = cache.get(key) if cached else None
+    if payee_id is not None:
+        return Payee(pk=payee_id, user=user, name=name)
+    payee, _ = Payee.objects.shard(user).get_or_create(user=user, name=name)
+    transaction.on_commit(partial(cache.set, key, payee.pk, CACHE_TIMEOUT), using=payee._state.db)
+    return payee
+
+
+def forget_payees(user, names):
+    """Drop cached payee ids of ``user`` (a User or user id), e.g. once the payees were deleted."""
+    cache.delete_many([_cache_key(user, name) for name in names])
+
+
+def matching_payees(user, query):
+    """Payees whose name contains ``query``, for filtering transactions by payee id."""
+    return Payee.objects.for_user(user).filter(name__icontains=normalize_payee_name(query))
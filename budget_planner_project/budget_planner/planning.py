@@ -0,0 +1,65 @@
+"""Set-based writes for budget goals: the yearly plan grid and copy-forward.
+
+Both lean on the ``(user, category, month, year)`` unique constraint instead
+of checking for existing goals first, so concurrent submissions cannot create
+duplicates. Neither sends model signals; callers follow up with
+``signals.bulk_changed``.
+"""
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import BudgetGoal, next_sequence
+from .sharding import check_writable, shard_for_user
+
+
+def save_goals(user, year, amounts):
+    """Create or update the user's goals for ``year`` in one upsert.
+
+    ``amounts`` maps ``(category_id, month)`` to the new amount. Returns the
+    number of goals written.
+    """
+    goals = [
+        BudgetGoal(user=user, category_id=category_id, month=month, year=year, amount=amount)
+        for (category_id, month), amount in amounts.items()
+    ]
+    BudgetGoal.objects.shard(user).bulk_create(
+        goals, update_conflicts=True,
+        unique_fields=['user', 'category', 'month', 'year'],
+        update_fields=['amount', 'updated_at'],
+    )
+    return len(goals)
+
+
+def copy_goals_forward(user, year, month=None):
+    """Copy last month's goals into ``month``/``year``, or last year's into ``year``.
+
+    Runs as a single ``INSERT ... SELECT``; goals that already exist in the
+    target period are kept. Returns the number of goals created.
+    """
+    using = shard_for_user(user)
+    check_writable(user.pk, using)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(BudgetGoal._meta.db_table)
+    if month is None:
+        source = 'year = %s'
+        source_params = [year - 1]
+        target_month, target_year = 'month', '%s'
+        target_params = [year]
+    else:
+        previous = year * 12 + month - 2
+        source = 'year = %s AND month = %s'
+        source_params = [previous // 12, previous % 12 + 1]
+        target_month, target_year = '%s', '%s'
+        target_params = [month, year]
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    sql = (
+        f'INSERT INTO {table} (user_id, category_id, amount, month, year, created_at, updated_at, sequence) '
+        f'SELECT user_id, category_id, amount, {target_month}, {target_year}, %s, %s, %s '
+        f'FROM {table} WHERE user_id = %s AND {source} '
+        f'ON CONFLICT (user_id, category_id, month, year) DO NOTHING'
+    )
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        sequence = next_sequence(user.pk, using)
+        cursor.execute(sql, [*target_params, now, now, sequence, user.pk, *source_params])
+        return cursor.rowcount
@@ -0,0 +1,191 @@
+"""On-demand request profiling.
+
+``ProfilingMiddleware`` runs a request under cProfile and records every SQL
+query it sends, on every database connection (shards included), with its
+duration. Each profiled request leaves two files in ``PROFILING_DIR``: a
+``.prof`` dump for ``snakeviz``/``pstats`` and a ``.json`` summary of the
+slowest functions and queries, which the admin's profile pages display.
+
+Staff trigger a profile with the ``X-Profile`` header or the ``_profile``
+query parameter. ``PROFILING_SAMPLE_RATE`` additionally profiles that share
+of all authenticated requests, to catch slow pages on other users' data;
+summaries hold SQL with placeholders, never parameter values.
+"""
+import cProfile
+import json
+import logging
+import pstats
+import random
+import re
+import threading
+import time
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+TOP_FUNCTIONS = 40
+TOP_QUERIES = 25
+
+PROFILE_NAME_RE = re.compile(r'^\d{8}T\d{12}-[\w.-]{1,64}$')
+
+# Only one cProfile profiler can be active per process (enabling a second
+# one raises ValueError on Python 3.12+), so concurrent requests skip it.
+_profiler_lock = threading.Lock()
+
+
+def profiling_dir():
+    return Path(settings.PROFILING_DIR)
+
+
+class QueryRecorder:
+    """``execute_wrapper`` hook timing each query sent on a connection."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((context['connection'].alias, sql, time.perf_counter() - start))
+
+    def summary(self):
+        """Queries grouped by alias and SQL text, most total time first."""
+        grouped = {}
+        for alias, sql, duration in self.queries:
+            entry = grouped.setdefault((alias, sql), {'alias': alias, 'sql': sql, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            entry['count'] += 1
+            entry['total_ms'] += duration * 1000
+            entry['max_ms'] = max(entry['max_ms'], duration * 1000)
+        for entry in grouped.values():
+            entry['total_ms'] = round(entry['total_ms'], 3)
+            entry['max_ms'] = round(entry['max_ms'], 3)
+        return sorted(grouped.values(), key=lambda entry: entry['total_ms'], reverse=True)
+
+
+def _top_functions(profiler):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {
+            'function': pstats.func_std_string(func),
+            'calls': calls,
+            'tottime_ms': round(tottime * 1000, 3),
+            'cumtime_ms': round(cumtime * 1000, 3),
+        }
+        for func, (primitive_calls, calls, tottime, cumtime, callers) in rows
+    ]
+
+
+def _prune(directory):
+    """Keep only the newest ``PROFILING_KEEP`` profiles."""
+    summaries = sorted(directory.glob('*.json'), reverse=True)
+    for summary in summaries[settings.PROFILING_KEEP:]:
+        summary.unlink(missing_ok=True)
+        summary.with_suffix('.prof').unlink(missing_ok=True)
+
+
+def write_profile(request, response, profiler, recorder, started_at, duration):
+    """Dump the profile and its JSON summary; return the profile's name."""
+    directory = profiling_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    name = f'{started_at:%Y%m%dT%H%M%S%f}-{request.id}'
+    profiler.dump_stats(directory / f'{name}.prof')
+    queries = recorder.summary()
+    summary = {
+        'name': name,
+        'method': request.method,
+        'path': request.get_full_path(),
+        'status': response.status_code,
+        'user_id': request.user.pk if request.user.is_authenticated else None,
+        'request_id': request.id,
+        'started_at': started_at.isoformat(),
+        'duration_ms': round(duration * 1000, 3),
+        'query_count': len(recorder.queries),
+        'query_ms': round(sum(entry['total_ms'] for entry in queries), 3),
+        'functions': _top_functions(profiler),
+        'queries': queries[:TOP_QUERIES],
+    }
+    (directory / f'{name}.json').write_text(json.dumps(summary, indent=2))
+    _prune(directory)
+    return name
+
+
+def recent_profiles(limit=100):
+    """Summaries of the newest profiles, without their function and query lists."""
+    profiles = []
+    for path in sorted(profiling_dir().glob('*.json'), reverse=True)[:limit]:
+        try:
+            summary = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue
+        summary.pop('functions', None)
+        summary.pop('queries', None)
+        profiles.append(summary)
+    return profiles
+
+
+def profile_path(name, suffix):
+    """Path of one profile's file, or ``None`` for a name that isn't a profile."""
+    if not PROFILE_NAME_RE.match(name):
+        return None
+    path = profiling_dir() / f'{name}{suffix}'
+    return path if path.is_file() else None
+
+
+class ProfilingMiddleware:
+    """Profile requests asked for by staff, plus a random sample of all requests.
+
+    Must come after ``AuthenticationMiddleware`` and
+    ``RequestContextMiddleware``. The profile's name is returned in the
+    ``X-Profile-ID`` response header. Requests arriving while another is
+    being profiled in the same process are served unprofiled.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def should_profile(self, request):
+        if not request.user.is_authenticated:
+            return False
+        if request.user.is_staff and (request.headers.get('X-Profile') or '_profile' in request.GET):
+            return True
+        return random.random() < settings.PROFILING_SAMPLE_RATE
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+        if not _profiler_lock.acquire(blocking=False):
+            logger.debug('Not profiling %s: another request is being profiled', request.path)
+            return self.get_response(request)
+        try:
+            return self._profile(request)
+        finally:
+            _profiler_lock.release()
+
+    def _profile(self, request):
+        recorder = QueryRecorder()
+        profiler = cProfile.Profile()
+        started_at = timezone.now()
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(recorder))
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        duration = time.perf_counter() - start
+
+        try:
+            response['X-Profile-ID'] = write_profile(request, response, profiler, recorder, started_at, duration)
+        except OSError:
+            logger.exception('Could not write profile for %s', request.path)
+        return response
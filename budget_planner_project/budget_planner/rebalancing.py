@@ -0,0 +1,176 @@
+"""Move users' budget data between database shards.
+
+See ``sharding`` for how users are placed. A move marks the user's
+``ShardAssignment`` as moving, which refuses their writes, copies their rows
+to the new shard in primary-key batches, switches the assignment and then
+purges the old shard. The user stays readable throughout.
+"""
+import time
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .forecasting import refresh_forecasts
+from .models import BudgetGoal, Category, ChangeStamp, Payee, ShardAssignment, Tombstone, Transaction
+from .sharding import purge_user_data, shard_aliases, shard_for_user, shard_loads
+
+MOVE_BATCH_SIZE = 1000
+
+# How long writes that passed their ``check_writable`` just before the user
+# was marked as moving get to finish.
+MOVE_DRAIN_SECONDS = 2
+
+
+class ShardMoveConflict(Exception):
+    """The user's data changed on the source shard while it was being copied."""
+
+
+def _copy_rows(model, user_id, source, target, batch_size, remap=None, skip=None):
+    """Copy a user's rows of ``model`` in pk batches; return ``{old_pk: new_pk}``."""
+    remap = remap or {}
+    # bulk_create stamps auto_now_add fields with the current time; put them back.
+    preserved = [f.name for f in model._meta.concrete_fields if getattr(f, 'auto_now_add', False)]
+    ids = {}
+    last_pk = 0
+    while True:
+        batch = list(
+            model.objects.using(source).filter(user_id=user_id, pk__gt=last_pk).order_by('pk')[:batch_size]
+        )
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+        if skip is not None:
+            batch = [obj for obj in batch if not skip(obj)]
+        old_pks = [obj.pk for obj in batch]
+        saved = [[getattr(obj, name) for name in preserved] for obj in batch]
+        for obj in batch:
+            obj.pk = None
+            for field, mapping in remap.items():
+                value = getattr(obj, field)
+                if value is not None:
+                    setattr(obj, field, mapping[value])
+        model.objects.using(target).bulk_create(batch)
+        if preserved:
+            for obj, values in zip(batch, saved):
+                for name, value in zip(preserved, values):
+                    setattr(obj, name, value)
+            model.objects.using(target).bulk_update(batch, preserved)
+        ids.update(zip(old_pks, (obj.pk for obj in batch)))
+    return ids
+
+
+def _stamp_version(user_id, using):
+    return ChangeStamp.objects.using(using).filter(user_id=user_id).values_list('version', flat=True).first()
+
+
+def move_user(user_id, target, batch_size=MOVE_BATCH_SIZE, drain=MOVE_DRAIN_SECONDS):
+    """Move one user's budget data to the ``target`` shard and return the rows copied.
+
+    The user is marked as moving, so their writes are refused until the move
+    ends, and ``drain`` seconds are given to writes already under way. The
+    rows are then copied in batches inside one transaction on ``target``.
+    Finally, holding the source's write lock, the user's change stamp is
+    checked for writes that slipped in, the assignment is switched and the
+    source is purged. Primary keys are per database, so copied rows get new
+    ids: old ids are tombstoned on the target and every copied row gets a
+    fresh sync ``sequence``, so sync clients drop the old ids and fetch the
+    new ones. Raises ``ShardMoveConflict`` (and leaves the user where they were)
+    if their data changed during the move.
+
+    No cache needs clearing, in this process or any other: category
+    registries are keyed by the change stamp version, which the move bumps,
+    and payee ids by the user's placement, which the move changes.
+    """
+    if target not in shard_aliases():
+        raise ValueError(f'Unknown database shard {target!r}')
+    source = shard_for_user(user_id)
+    if source == target:
+        return 0
+
+    assignment = ShardAssignment.objects.filter(user_id=user_id)
+    assignment.update(moving=True)
+    try:
+        time.sleep(drain)
+        # Every write bumps the stamp, so its version tells whether any landed.
+        ChangeStamp.objects.using(source).get_or_create(user_id=user_id)
+        version = _stamp_version(user_id, source)
+
+        # Leftovers of an earlier, interrupted move.
+        purge_user_data(user_id, target)
+        with transaction.atomic(using=target):
+            copied = _copy_user(user_id, source, target, batch_size, version)
+
+        with transaction.atomic(using=source):
+            # Take the source's write lock (the stamp row's, on databases with
+            # row locks) so nothing can land there until the old rows are gone.
+            ChangeStamp.objects.using(source).filter(user_id=user_id).update(version=F('version'))
+            if _stamp_version(user_id, source) != version:
+                raise ShardMoveConflict(f'User {user_id} changed their data during the move; try again')
+            purge_user_data(user_id, source)
+            assignment.update(shard=target, assigned_at=timezone.now())
+    except BaseException:
+        if assignment.values_list('shard', flat=True).first() != target:
+            purge_user_data(user_id, target)
+        raise
+    finally:
+        assignment.update(moving=False)
+
+    refresh_forecasts([user_id])
+    return copied
+
+
+def _copy_user(user_id, source, target, batch_size, version):
+    categories = _copy_rows(Category, user_id, source, target, batch_size)
+    payees = _copy_rows(Payee, user_id, source, target, batch_size)
+    transactions = _copy_rows(
+        Transaction, user_id, source, target, batch_size,
+        remap={'category_id': categories, 'payee_id': payees},
+    )
+    goals = _copy_rows(
+        BudgetGoal, user_id, source, target, batch_size,
+        remap={'category_id': categories},
+    )
+
+    # A client must not apply an old deletion to a row that now has that id.
+    moved = {'category': categories, 'transaction': transactions, 'budget_goal': goals}
+    new_ids = {model: set(ids.values()) for model, ids in moved.items()}
+    _copy_rows(
+        Tombstone, user_id, source, target, batch_size,
+        skip=lambda t: t.object_id in new_ids[t.model],
+    )
+    Tombstone.objects.using(target).bulk_create(
+        [
+            Tombstone(user_id=user_id, model=model, object_id=old_id)
+            for model, ids in moved.items()
+            for old_id in ids.keys() - new_ids[model]
+        ],
+        batch_size=batch_size,
+    )
+
+    for model in [Category, Transaction, BudgetGoal, Tombstone]:
+        model.objects.using(target).filter(user_id=user_id).update(sequence=version + 1)
+    ChangeStamp.objects.using(target).create(user_id=user_id, version=version + 1, changed_at=timezone.now())
+    return sum(len(ids) for ids in [categories, payees, transactions, goals])
+
+
+def rebalance_plan():
+    """``(user_id, source, target)`` moves that even out the number of users per shard."""
+    loads = shard_loads()
+    moves = []
+    while True:
+        fullest = max(loads, key=loads.get)
+        emptiest = min(loads, key=loads.get)
+        if loads[fullest] - loads[emptiest] <= 1:
+            return moves
+        # Move the most recently assigned users first; they have the least data.
+        planned = {user_id for user_id, _, _ in moves}
+        user_id = (
+            ShardAssignment.objects.filter(shard=fullest).exclude(user_id__in=planned)
+            .order_by('-assigned_at').values_list('user_id', flat=True).first()
+        )
+        if user_id is None:
+            return moves
+        moves.append((user_id, fullest, emptiest))
+        loads[fullest] -= 1
+        loads[emptiest] += 1
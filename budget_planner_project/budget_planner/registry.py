@@ -0,0 +1,63 @@
+"""Per-user category registry kept in the cache.
+
+Forms and list views need the same small set of categories on almost every
+request. The registry loads them once per user and keeps id lookups, the
+income/expense split and ready-made choice tuples together. The cache key
+carries the user's change stamp version, which every category write bumps in
+the database, so all workers stop using an outdated copy at the same time.
+"""
+from django.core.cache import cache
+from django.db import connections
+
+from .models import Category
+from .sharding import shard_for_user
+from .stamps import get_change_stamp
+
+CACHE_TIMEOUT = 60 * 60
+
+
+def _cache_key(user_id, version):
+    return f'category_registry:{user_id}:{version}'
+
+
+class CategoryRegistry:
+    def __init__(self, categories):
+        self.categories = list(categories)
+        self.by_id = {category.pk: category for category in self.categories}
+        self.income = [c for c in self.categories if c.type == 'income']
+        self.expense = [c for c in self.categories if c.type == 'expense']
+        self._choices = {
+            None: [(c.pk, str(c)) for c in self.categories],
+            'income': [(c.pk, str(c)) for c in self.income],
+            'expense': [(c.pk, str(c)) for c in self.expense],
+        }
+
+    def get(self, pk):
+        return self.by_id.get(pk)
+
+    def of_type(self, type=None):
+        if type is None:
+            return self.categories
+        return self.income if type == 'income' else self.expense
+
+    def choices(self, type=None):
+        return self._choices[type]
+
+    def attach(self, objects):
+        """Fill ``obj.category`` from the registry so templates don't query it."""
+        for obj in objects:
+            category = self.by_id.get(obj.category_id)
+            if category is not None:
+                obj.category = category
+        return objects
+
+
+def get_category_registry(user):
+    key = _cache_key(user.pk, get_change_stamp(user).version)
+    registry = cache.get(key)
+    if registry is None:
+        registry = CategoryRegistry(Category.objects.for_user(user))
+        # Categories read inside a transaction may still be rolled back.
+        if not connections[shard_for_user(user)].in_atomic_block:
+            cache.set(key, registry, CACHE_TIMEOUT)
+    return registry
@@ -0,0 +1,177 @@
+"""Spread users' budget data over several databases by user id.
+
+Auth, sessions, the admin log and ``ShardAssignment`` stay on ``default``.
+Every model in ``SHARDED_MODELS`` lives on the shard recorded for its user in
+``ShardAssignment``. ``default`` is also the first shard, so a single-database
+setup behaves exactly as before and never looks an assignment up.
+
+Reads must say which shard to use: ``Model.objects.for_user(user)`` or
+``.using(shard_for_user(user))``. Saving or deleting a model instance is
+routed by its user automatically. Rows of one user never span shards, so
+joins between the sharded models keep working; joins to ``auth_user`` do not.
+
+While a user is being moved (``ShardAssignment.moving``), saving or deleting
+their rows, and set-based writes through ``for_user``/``shard`` querysets,
+raise ``ShardMoveInProgress``.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count
+
+APP_LABEL = 'budget_planner'
+
+class ShardMoveInProgress(Exception):
+    """A write for a user whose data is being moved to another shard."""
+
+
+SHARDED_MODELS = {
+    'budget_planner.category',
+    'budget_planner.payee',
+    'budget_planner.transaction',
+    'budget_planner.budgetgoal',
+    'budget_planner.spendingforecast',
+    'budget_planner.tombstone',
+    'budget_planner.changestamp',
+}
+
+
+def shard_aliases():
+    return getattr(settings, 'DATABASE_SHARDS', [DEFAULT_DB_ALIAS])
+
+
+def _assignment_model():
+    return apps.get_model(APP_LABEL, 'ShardAssignment')
+
+
+def shard_loads():
+    """Map every shard alias to the number of users assigned to it."""
+    counts = dict(
+        _assignment_model().objects.values_list('shard').annotate(n=Count('user')).order_by()
+    )
+    return {alias: counts.get(alias, 0) for alias in shard_aliases()}
+
+
+def _has_rows(user_id, using):
+    return any(model.objects.using(using).filter(user_id=user_id).exists() for model in _sharded_models())
+
+
+def _lookup_placement(user_id):
+    ShardAssignment = _assignment_model()
+    placement = ShardAssignment.objects.filter(user_id=user_id).values_list('shard', 'assigned_at').first()
+    if placement is None:
+        if _has_rows(user_id, DEFAULT_DB_ALIAS):
+            # Stored before shards were configured (or before migration 0010).
+            shard = DEFAULT_DB_ALIAS
+        else:
+            loads = shard_loads()
+            shard = min(loads, key=loads.get)
+        assignment, _ = ShardAssignment.objects.get_or_create(user_id=user_id, defaults={'shard': shard})
+        placement = (assignment.shard, assignment.assigned_at)
+    if placement[0] not in shard_aliases():
+        raise ImproperlyConfigured(f'User {user_id} is assigned to unknown database shard {placement[0]!r}')
+    return placement
+
+
+def user_placement(user):
+    """``(shard alias, assignment time)`` of ``user`` (a User or user id).
+
+    The assignment time changes whenever the user is moved, so the pair never
+    repeats across moves, even when a user comes back to an earlier shard.
+    New users are placed on the shard with the fewest users; users without an
+    assignment whose rows are already on ``default`` stay there. The answer is
+    remembered on a ``User`` instance for the rest of the request.
+    """
+    aliases = shard_aliases()
+    if len(aliases) == 1:
+        return aliases[0], None
+    if not isinstance(user, User):
+        return _lookup_placement(user)
+    if not hasattr(user, '_placement'):
+        user._placement = _lookup_placement(user.pk)
+    return user._placement
+
+
+def shard_for_user(user):
+    """Alias of the database holding the budget data of ``user`` (a User or user id)."""
+    return user_placement(user)[0]
+
+
+def check_writable(user_id, using):
+    """Refuse writes to ``using`` for a user being moved, or no longer stored there.
+
+    Reads the assignment afresh, so a request that looked the shard up before
+    a move started cannot write to the old shard afterwards.
+    """
+    if len(shard_aliases()) == 1:
+        return
+    assignment = _assignment_model().objects.filter(user_id=user_id).values_list('shard', 'moving').first()
+    if assignment is not None and (assignment[1] or assignment[0] != using):
+        raise ShardMoveInProgress(f'The data of user {user_id} is moving, or has moved, to another shard')
+
+
+def split_by_shard(user_ids):
+    """Map shard alias -> the given user ids stored on it.
+
+    ``user_ids`` may be one id, a list, or ``None`` for every user, in which
+    case each shard maps to ``None``.
+    """
+    if user_ids is None:
+        return dict.fromkeys(shard_aliases())
+    if isinstance(user_ids, int):
+        user_ids = [user_ids]
+    by_shard = {}
+    for user_id in user_ids:
+        by_shard.setdefault(shard_for_user(user_id), []).append(user_id)
+    return by_shard
+
+
+class UserShardRouter:
+    """Send sharded models to their user's shard and everything else to ``default``."""
+
+    def _db_for(self, model, **hints):
+        if model._meta.label_lower not in SHARDED_MODELS:
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._state.db and instance._meta.label_lower in SHARDED_MODELS:
+            return instance._state.db
+        if isinstance(instance, User):
+            return shard_for_user(instance)
+        user_id = getattr(instance, 'user_id', None)
+        return None if user_id is None else shard_for_user(user_id)
+
+    db_for_read = _db_for
+    db_for_write = _db_for
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.label_lower in SHARDED_MODELS and obj2._meta.label_lower in SHARDED_MODELS:
+            return obj1._state.db == obj2._state.db
+        # The user foreign keys cross databases (they are db_constraint=False).
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == APP_LABEL and (model_name is None or f'{app_label}.{model_name}' in SHARDED_MODELS):
+            return db in shard_aliases()
+        return db == DEFAULT_DB_ALIAS
+
+
+def _sharded_models():
+    """Sharded models, children before the parents they reference."""
+    return [
+        apps.get_model(APP_LABEL, name)
+        for name in ['SpendingForecast', 'BudgetGoal', 'Transaction', 'Payee', 'Category', 'Tombstone', 'ChangeStamp']
+    ]
+
+
+def purge_user_data(user_id, using):
+    """Delete every row of ``user_id`` from one shard without sending model signals."""
+    connection = connections[using]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        for model in _sharded_models():
+            table = connection.ops.quote_name(model._meta.db_table)
+            column = connection.ops.quote_name(model._meta.get_field('user').column)
+            cursor.execute(f'DELETE FROM {table} WHERE {column} = %s', [user_id])
@@ -0,0 +1,170 @@
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .forecasting import refresh_category_forecasts, refresh_forecasts
+from . import live
+from .models import BudgetGoal, Category, Payee, ShardAssignment, Tombstone, Transaction
+from .payees import forget_payees
+from .sharding import check_writable, purge_user_data, shard_for_user
+
+
+def schedule_forecast_refresh(user_id, using=None):
+    transaction.on_commit(partial(refresh_forecasts, [user_id]), using=using)
+
+
+def schedule_live_update(user_id, using=None):
+    """Have the user's open dashboards reload after writes that send no delta."""
+    # Registered after the forecast refresh, so the snapshot sees fresh forecasts.
+    if live.broker.has_subscribers(user_id):
+        transaction.on_commit(partial(live.publish_resync, user_id), using=using)
+
+
+def bulk_changed(user):
+    """Follow-up for ``QuerySet.update()`` calls, which send no model signals.
+
+    The change stamp needs no bump: writes to synced models bump it themselves
+    (``models.next_sequence``).
+    """
+    using = shard_for_user(user)
+    schedule_forecast_refresh(user.pk, using)
+    schedule_live_update(user.pk, using)
+
+
+def _first_for_origin(origin, tag, user_id):
+    """Queryset deletes send one signal per row; act once per user."""
+    if not isinstance(origin, QuerySet):
+        return True
+    seen = origin.__dict__.setdefault(tag, set())
+    if user_id in seen:
+        return False
+    seen.add(user_id)
+    return True
+
+
+@receiver(pre_save, sender=Transaction)
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Payee)
+@receiver(pre_save, sender=BudgetGoal)
+def user_data_saving(sender, instance, using, raw=False, **kwargs):
+    if not raw:
+        check_writable(instance.user_id, using)
+
+
+@receiver(pre_delete, sender=Transaction)
+@receiver(pre_delete, sender=Category)
+@receiver(pre_delete, sender=Payee)
+@receiver(pre_delete, sender=BudgetGoal)
+def user_data_deleting(sender, instance, using, origin=None, **kwargs):
+    if not isinstance(origin, User) and _first_for_origin(origin, '_writable_users', instance.user_id):
+        check_writable(instance.user_id, using)
+
+
+@receiver(pre_save, sender=Transaction)
+def transaction_saving(sender, instance, using, raw=False, **kwargs):
+    # An edit moving the row to another category changes that one's forecast
+    # too, and live dashboards take the old amount off their totals.
+    if not raw and not instance._state.adding:
+        instance._previous = (
+            Transaction.objects.using(using).filter(pk=instance.pk)
+            .values('type', 'amount', 'date', 'category_id').first()
+        )
+
+
+@receiver(post_save, sender=Transaction)
+def transaction_saved(sender, instance, using, **kwargs):
+    # Only the row's categories change, so refresh just those, in the write's
+    # transaction; a whole-user refresh reads 13 months of every category.
+    previous = getattr(instance, '_previous', None)
+    category_ids = {instance.category_id, previous and previous['category_id']} - {None}
+    if category_ids:
+        refresh_category_forecasts(instance.user_id, category_ids, using)
+
+
+@receiver(post_delete, sender=Transaction)
+def transaction_deleted(sender, instance, using, origin=None, **kwargs):
+    # Skip cascades from the user (or another parent) being deleted.
+    if isinstance(origin, Transaction):
+        if instance.category_id is not None:
+            refresh_category_forecasts(instance.user_id, [instance.category_id], using)
+    elif isinstance(origin, QuerySet) and _first_for_origin(origin, '_forecast_users', instance.user_id):
+        schedule_forecast_refresh(instance.user_id, using)
+
+
+@receiver(post_delete, sender=Payee)
+def payee_deleted(sender, instance, using, **kwargs):
+    transaction.on_commit(partial(forget_payees, instance.user_id, [instance.name]), using=using)
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting(sender, instance, using, origin=None, **kwargs):
+    # Transactions are about to have their category SET_NULL by a plain
+    # UPDATE; bump them so sync clients pick up the change.
+    if not isinstance(origin, User):
+        Transaction.objects.shard(instance.user_id).filter(category=instance).update(updated_at=timezone.now())
+
+
+TOMBSTONE_MODELS = {
+    Transaction: 'transaction',
+    Category: 'category',
+    BudgetGoal: 'budget_goal',
+}
+
+
+@receiver(post_delete, sender=Transaction)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=BudgetGoal)
+def record_tombstone(sender, instance, using, origin=None, **kwargs):
+    if isinstance(origin, User):
+        return
+    tombstone = Tombstone(user_id=instance.user_id, model=TOMBSTONE_MODELS[sender], object_id=instance.pk)
+    if origin is not None and origin is not instance:
+        # Written in one batch once the whole delete is done (``models.write_pending_tombstones``).
+        origin.__dict__.setdefault('_pending_tombstones', []).append(tombstone)
+        return
+    tombstone.save(using=using)
+    # The deletion is the row's last write.
+    instance.sequence = tombstone.sequence
+
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=BudgetGoal)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=BudgetGoal)
+def user_data_changed(sender, instance, using, signal, origin=None, **kwargs):
+    # The write (or its tombstone) already bumped the user's change stamp;
+    # what is left is telling the user's open dashboards.
+    if isinstance(origin, User) or not live.broker.has_subscribers(instance.user_id):
+        return
+    deleted = signal is post_delete
+    if deleted and origin is not instance:
+        # Queryset deletes and cascades: one reload per user.
+        if _first_for_origin(origin, '_live_users', instance.user_id):
+            schedule_live_update(instance.user_id, using)
+    elif sender is Transaction:
+        delta = live.transaction_delta(instance, getattr(instance, '_previous', None), deleted)
+        transaction.on_commit(partial(live.publish_delta, instance.user_id, 'transaction', delta), using=using)
+    elif sender is BudgetGoal:
+        delta = live.goal_delta(instance, deleted)
+        transaction.on_commit(partial(live.publish_delta, instance.user_id, 'goal', delta), using=using)
+    elif deleted:
+        # A category's goals go with it and its transactions lose it.
+        schedule_live_update(instance.user_id, using)
+    else:
+        delta = live.category_delta(instance)
+        transaction.on_commit(partial(live.publish_delta, instance.user_id, 'category', delta), using=using)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleting(sender, instance, using, **kwargs):
+    # The user's cascade only reaches rows on the database the user lives in.
+    shard = ShardAssignment.objects.filter(user=instance).values_list('shard', flat=True).first()
+    if shard is not None and shard != DEFAULT_DB_ALIAS:
+        transaction.on_commit(partial(purge_user_data, instance.pk, shard), using=using)
@@ -0,0 +1,88 @@
+"""Per-user change stamps and conditional GET for the authenticated pages.
+
+Every write to a user's transactions, categories or goals bumps their
+``ChangeStamp``. Pages decorated with ``conditional_page`` derive their ETag
+and Last-Modified from it, so a revalidating browser gets a 304 after a
+single primary-key lookup instead of re-running the view.
+"""
+import hashlib
+from datetime import datetime, time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from .models import ChangeStamp
+from .sharding import split_by_shard
+
+
+def bump_change_stamp(user_ids, using=None):
+    """Invalidate cached pages for the given user id(s), or everyone for ``None``.
+
+    Pass ``using`` when the caller already knows the shard holding the users.
+    """
+    by_shard = {using: user_ids} if using else split_by_shard(user_ids)
+    for alias, shard_user_ids in by_shard.items():
+        stamps = ChangeStamp.objects.using(alias)
+        if isinstance(shard_user_ids, int):
+            stamps = stamps.filter(user_id=shard_user_ids)
+        elif shard_user_ids is not None:
+            stamps = stamps.filter(user_id__in=shard_user_ids)
+        stamps.update(version=F('version') + 1, changed_at=timezone.now())
+
+
+def get_change_stamp(user):
+    stamp, _ = ChangeStamp.objects.shard(user).get_or_create(user=user)
+    return stamp
+
+
+def _request_stamp(request):
+    """The stamp to validate against, or None when the page must be rendered."""
+    if not hasattr(request, '_change_stamp'):
+        stamp = None
+        # Pending flash messages are shown (and consumed) by the next render,
+        # so never answer 304 or hand out a validator for that page.
+        if request.user.is_authenticated and not len(messages.get_messages(request)):
+            stamp = get_change_stamp(request.user)
+        request._change_stamp = stamp
+    return request._change_stamp
+
+
+def _etag(request, *args, **kwargs):
+    stamp = _request_stamp(request)
+    if stamp is None:
+        return None
+    parts = [
+        str(stamp.user_id),
+        str(stamp.version),
+        request.user.get_username(),
+        request.get_full_path(),
+        # Pages depend on the current month and embed the CSRF token.
+        timezone.localdate().isoformat(),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME, ''),
+    ]
+    return hashlib.sha256('|'.join(parts).encode()).hexdigest()[:32]
+
+
+def _last_modified(request, *args, **kwargs):
+    stamp = _request_stamp(request)
+    if stamp is None:
+        return None
+    start_of_day = timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+    return max(stamp.changed_at, start_of_day)
+
+
+def conditional_page(view):
+    """Answer unchanged GETs of a per-user page with 304 before the view runs."""
+    conditional_view = condition(etag_func=_etag, last_modified_func=_last_modified)(view)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    return wrapper
@@ -1,3 +1,804 @@
-from django.test import TestCase
+from datetime import date, timedelta
+from decimal import Decimal
+import io
+import json
+import logging
+import sys
+import tempfile
+from importlib import import_module
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections
+from django.db.transaction import atomic
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import live, profiling, rebalancing
+from .forecasting import MIN_TO_DATE_SHARE, _shift_month, compute_forecasts, forecasts_for
+from .forms import BudgetGoalForm, TransactionForm
+from .log import JSONFormatter, RequestContextFilter, queue_listener_handler
+from .models import BudgetGoal, Category, ChangeStamp, Payee, ShardAssignment, Tombstone, Transaction
+from .payees import resolve_payee
+from .planning import copy_goals_forward
+from .registry import get_category_registry
+from .sharding import ShardMoveInProgress, shard_aliases, shard_for_user
+from .stamps import bump_change_stamp, get_change_stamp
+
+PASSWORD = 'Tr0ub4dor&3horse'
+
+
+def make_user(username, shard):
+    user = User.objects.create_user(username, password=PASSWORD)
+    ShardAssignment.objects.create(user=user, shard=shard)
+    return user
+
+
+def add_transaction(user, category, amount, description='Groceries', day=None):
+    return Transaction.objects.shard(user).create(
+        user=user, category=category, type=category.type, amount=amount,
+        payee=resolve_payee(user, description), date=day or date.today(),
+    )
+
+
+def user_rows(model, user_id, using):
+    return model.objects.using(using).filter(user_id=user_id)
+
+
+class ShardedTestCase(TestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+
+
+class ShardRoutingTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.client.login(username='alice', password=PASSWORD)
+
+    def test_tests_run_with_several_shards(self):
+        self.assertEqual(
+            shard_aliases(), ['default', 'shard1', 'shard2'], 'Run the tests with --settings=config.test_settings.'
+        )
+
+    def test_new_users_spread_over_shards(self):
+        users = [User.objects.create_user(f'user{n}') for n in range(3)]
+        # alice already sits on shard1.
+        self.assertEqual(sorted(shard_for_user(u.pk) for u in users[:2]), ['default', 'shard2'])
+
+    def test_views_write_to_the_users_shard(self):
+        self.client.post('/categories/add/', {'name': 'Rent', 'type': 'expense', 'icon': 'bi-house', 'color': 'primary'})
+        self.client.post('/transactions/add/', {
+            'type': 'expense', 'category': self.food.pk, 'amount': '12.50',
+            'description': 'Corner Shop', 'date': date.today().isoformat(),
+        })
+
+        self.assertTrue(user_rows(Category, self.user.pk, 'shard1').filter(name='Rent').exists())
+        transaction = user_rows(Transaction, self.user.pk, 'shard1').select_related('payee').get()
+        self.assertEqual(transaction.description, 'Corner Shop')
+        for model in [Category, Payee, Transaction]:
+            self.assertFalse(user_rows(model, self.user.pk, 'default').exists())
+
+        response = self.client.get('/transactions/')
+        self.assertContains(response, 'Corner Shop')
+
+    def test_form_only_offers_the_users_categories(self):
+        other = make_user('bob', 'shard2')
+        for name in ['Rent', 'Travel']:
+            Category.objects.shard(other).create(user=other, name=name, type='expense')
+        unknown_pk = user_rows(Category, other.pk, 'shard2').latest('pk').pk
+
+        form = TransactionForm(self.user, {
+            'type': 'expense', 'category': unknown_pk, 'amount': '5',
+            'description': 'Taxi', 'date': date.today().isoformat(),
+        })
+
+        self.assertEqual([pk for pk, _ in form.fields['category'].choices if pk], [self.food.pk])
+        self.assertIn('category', form.errors)
+
+    def test_signals_write_to_the_users_shard(self):
+        transaction = add_transaction(self.user, self.food, 20)
+        version = get_change_stamp(self.user).version
+
+        self.client.post(f'/transactions/{transaction.pk}/delete/')
+
+        self.assertTrue(
+            user_rows(Tombstone, self.user.pk, 'shard1').filter(model='transaction', object_id=transaction.pk).exists()
+        )
+        self.assertGreater(ChangeStamp.objects.shard(self.user).get(user=self.user).version, version)
+        self.assertFalse(user_rows(Tombstone, self.user.pk, 'default').exists())
+        self.assertFalse(user_rows(ChangeStamp, self.user.pk, 'default').exists())
+
+    def test_writes_are_refused_while_the_user_moves(self):
+        ShardAssignment.objects.filter(user=self.user).update(moving=True)
+
+        response = self.client.post('/transactions/add/', {
+            'type': 'expense', 'category': self.food.pk, 'amount': '5',
+            'description': 'Taxi', 'date': date.today().isoformat(),
+        })
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(user_rows(Transaction, self.user.pk, 'shard1').exists())
+        with self.assertRaises(ShardMoveInProgress):
+            Category.objects.for_user(self.user).update(name='Meals')
+
+
+class MoveUserTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.goal = BudgetGoal.objects.shard(self.user).create(
+            user=self.user, category=self.food, amount=300, month=date.today().month, year=date.today().year,
+        )
+
+    def move(self, target='shard2'):
+        return rebalancing.move_user(self.user.pk, target, drain=0)
+
+    def test_move_copies_rows_and_purges_the_source(self):
+        add_transaction(self.user, self.food, 20)
+        add_transaction(self.user, self.food, 30, description='Market')
+        version = get_change_stamp(self.user).version
+
+        copied = self.move()
+
+        self.assertEqual(copied, 6)
+        assignment = ShardAssignment.objects.get(user=self.user)
+        self.assertEqual((assignment.shard, assignment.moving), ('shard2', False))
+        for model in [Category, Payee, Transaction, BudgetGoal, ChangeStamp]:
+            self.assertFalse(user_rows(model, self.user.pk, 'shard1').exists(), model)
+        moved = user_rows(Transaction, self.user.pk, 'shard2').select_related('category', 'payee')
+        self.assertEqual(sorted((t.description, t.category.name, t.amount) for t in moved),
+                         [('Groceries', 'Food', 20), ('Market', 'Food', 30)])
+        self.assertEqual(user_rows(BudgetGoal, self.user.pk, 'shard2').get().category.name, 'Food')
+        self.assertGreater(user_rows(ChangeStamp, self.user.pk, 'shard2').get().version, version)
+
+    def test_move_tombstones_old_ids_except_reused_ones(self):
+        deleted = add_transaction(self.user, self.food, 20)
+        kept = add_transaction(self.user, self.food, 30)
+        deleted_pk = deleted.pk
+        deleted.delete()
+
+        self.move()
+
+        new_pk = user_rows(Transaction, self.user.pk, 'shard2').get().pk
+        tombstoned = set(
+            user_rows(Tombstone, self.user.pk, 'shard2').filter(model='transaction').values_list('object_id', flat=True)
+        )
+        # The copied row's new id must never be reported as deleted.
+        self.assertNotIn(new_pk, tombstoned)
+        self.assertEqual(tombstoned, {deleted_pk, kept.pk} - {new_pk})
+
+    def test_conflicting_write_leaves_the_user_in_place(self):
+        add_transaction(self.user, self.food, 20)
+        copy_user = rebalancing._copy_user
+
+        def copy_during_write(user_id, source, *args):
+            bump_change_stamp(user_id, using=source)
+            return copy_user(user_id, source, *args)
+
+        with mock.patch.object(rebalancing, '_copy_user', copy_during_write):
+            with self.assertRaises(rebalancing.ShardMoveConflict):
+                self.move()
+
+        assignment = ShardAssignment.objects.get(user=self.user)
+        self.assertEqual((assignment.shard, assignment.moving), ('shard1', False))
+        self.assertEqual(user_rows(Transaction, self.user.pk, 'shard1').count(), 1)
+        self.assertFalse(user_rows(Transaction, self.user.pk, 'shard2').exists())
+
+    def test_rows_loaded_before_a_move_cannot_be_saved(self):
+        transaction = add_transaction(self.user, self.food, 20)
+
+        self.move()
+
+        transaction.amount = 25
+        with self.assertRaises(ShardMoveInProgress), atomic(using='shard1'):
+            transaction.save()
+        self.assertFalse(user_rows(Transaction, self.user.pk, 'shard1').exists())
+
+
+class UserDeletionTests(ShardedTestCase):
+    def test_deleting_a_user_purges_their_shard(self):
+        user = make_user('alice', 'shard2')
+        food = Category.objects.shard(user).create(user=user, name='Food', type='expense')
+        add_transaction(user, food, 20)
+        bump_change_stamp(user.pk)
+
+        with self.captureOnCommitCallbacks(using='default', execute=True):
+            user.delete()
+
+        for model in [Category, Payee, Transaction, ChangeStamp]:
+            self.assertFalse(user_rows(model, user.pk, 'shard2').exists(), model)
+
+
+class ProfilingMiddlewareTests(TestCase):
+    def setUp(self):
+        User.objects.create_user('admin', password=PASSWORD, is_staff=True)
+        self.client.login(username='admin', password=PASSWORD)
+        self.enterContext(override_settings(PROFILING_DIR=self.enterContext(tempfile.TemporaryDirectory())))
+
+    def test_staff_can_ask_for_a_profile(self):
+        response = self.client.get('/', {'_profile': 1})
+
+        self.assertIn('X-Profile-ID', response)
+        self.assertIsNotNone(profiling.profile_path(response['X-Profile-ID'], '.json'))
+
+    def test_concurrent_requests_are_not_profiled(self):
+        with profiling._profiler_lock:
+            response = self.client.get('/', {'_profile': 1})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-ID', response)
+
+
+class CustomReportTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        add_transaction(self.user, food, 20, day=date(2024, 3, 5))
+        self.client.login(username='alice', password=PASSWORD)
+
+    def test_report_for_a_range(self):
+        response = self.client.get('/reports/custom/', {'start': '2024-01-01', 'end': '2024-06-30', 'window': '7'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['window'], 7)
+        self.assertEqual(response.context['pivot_rows'][0]['total'], 20)
+
+    def test_invalid_ranges_are_rejected(self):
+        for params in [
+            {'start': '2024-02-30'},
+            {'start': '0001-01-01'},
+            {'start': '2010-01-01', 'end': '2024-01-01'},
+            {'window': '45'},
+        ]:
+            with self.subTest(**params):
+                response = self.client.get('/reports/custom/', params)
+                self.assertEqual(response.status_code, 400)
+                self.assertTrue(response.context['form'].errors)
+
+
+class SyncTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.client.login(username='alice', password=PASSWORD)
+
+    def sync(self, cursor=None, limit=None):
+        params = {key: value for key, value in [('cursor', cursor), ('limit', limit)] if value is not None}
+        return self.client.get('/api/sync/', params)
+
+    def test_pages_through_changes(self):
+        first, second, third = [add_transaction(self.user, self.food, amount) for amount in (1, 2, 3)]
+
+        page = self.sync(limit=2).json()
+        self.assertTrue(page['has_more'])
+        self.assertEqual([t['id'] for t in page['transactions']], [first.pk, second.pk])
+        page = self.sync(page['cursor'], limit=2).json()
+        self.assertFalse(page['has_more'])
+        self.assertEqual([t['id'] for t in page['transactions']], [third.pk])
+        self.assertEqual(self.sync(page['cursor']).json()['transactions'], [])
+
+        deleted_pk = first.pk
+        first.delete()
+        page = self.sync(page['cursor']).json()
+        self.assertEqual(page['deleted'], [{'model': 'transaction', 'id': deleted_pk, 'deleted_at': mock.ANY}])
+
+    def test_writes_stamped_before_the_cursor_are_still_sent(self):
+        transaction = add_transaction(self.user, self.food, 20)
+        cursor = self.sync().json()['cursor']
+
+        # A slow writer's timestamp can predate a sync that ran before it committed.
+        long_ago = timezone.now() - timedelta(hours=1)
+        Transaction.objects.for_user(self.user).update(amount=25, updated_at=long_ago)
+
+        changed = self.sync(cursor).json()['transactions']
+        self.assertEqual([(t['id'], t['amount']) for t in changed], [(transaction.pk, '25.00')])
+
+    def test_bad_parameters_are_rejected(self):
+        self.assertEqual(self.sync(limit='ten').status_code, 400)
+        self.assertEqual(self.sync(cursor='not-a-cursor').json(), {'error': 'Malformed sync cursor'})
+
+
+class ComputeForecastsTests(SimpleTestCase):
+    # Half of June has gone by.
+    today = date(2024, 6, 15)
+
+    def forecast(self, rows):
+        pairs, spent, projected = compute_forecasts(rows, self.today)
+        return {tuple(pair): (int(s), int(p)) for pair, s, p in zip(pairs.tolist(), spent, projected)}
+
+    def test_new_category_projects_its_run_rate(self):
+        rows = [(1, 10, date(2024, 6, 3), Decimal('12.00')), (1, 10, date(2024, 6, 10), Decimal('18.00'))]
+
+        self.assertEqual(self.forecast(rows), {(1, 10): (3000, 6000)})
+
+    def test_history_blends_the_pace_with_the_usual_month(self):
+        history = [(1, 10, _shift_month(date(2023, 6, 5), n).replace(day=5), Decimal('100.00')) for n in range(12)]
+        rows = history + [(1, 10, date(2024, 6, 5), Decimal('50.00')), (2, 20, date(2024, 6, 1), Decimal('5.00'))]
+
+        # Usually all spent by the 5th: pace 50, month average 100, half the month left.
+        self.assertEqual(self.forecast(rows), {(1, 10): (5000, 7500), (2, 20): (500, 1000)})
+
+    def test_share_spent_by_today_is_clamped(self):
+        # Spending for this category usually lands after the 15th.
+        rows = [(1, 10, date(2024, 5, 25), Decimal('100.00')), (1, 10, date(2024, 6, 1), Decimal('1.00'))]
+
+        pace = 100 / MIN_TO_DATE_SHARE
+        self.assertEqual(self.forecast(rows), {(1, 10): (100, round(0.5 * pace + 0.5 * 10000))})
+
+    def test_projection_never_falls_below_the_spend(self):
+        history = [(1, 10, date(2024, 5, 1), Decimal('10.00'))]
+
+        self.assertEqual(self.forecast(history + [(1, 10, date(2024, 6, 1), Decimal('80.00'))]), {(1, 10): (8000, 8000)})
+
+
+class ForecastRefreshTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.rent = Category.objects.shard(self.user).create(user=self.user, name='Rent', type='expense')
+
+    def spent(self):
+        today = timezone.localdate()
+        names = {self.food.pk: 'Food', self.rent.pk: 'Rent'}
+        return {
+            names[category_id]: forecast.spent
+            for category_id, forecast in forecasts_for(self.user, today.month, today.year).items()
+        }
+
+    def test_writes_refresh_their_categories(self):
+        groceries = add_transaction(self.user, self.food, 20)
+        add_transaction(self.user, self.rent, 500)
+        self.assertEqual(self.spent(), {'Food': 20, 'Rent': 500})
+
+        version = get_change_stamp(self.user).version
+        groceries.category = self.rent
+        groceries.save()
+        self.assertEqual(self.spent(), {'Rent': 520})
+        # The forecasts rode along with the write's own stamp bump.
+        self.assertEqual(get_change_stamp(self.user).version, version + 1)
+
+        groceries.delete()
+        self.assertEqual(self.spent(), {'Rent': 500})
+
+
+class LiveUpdateTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.enterContext(mock.patch.object(live.broker, 'has_subscribers', return_value=True))
+        self.publish = self.enterContext(mock.patch.object(live.broker, 'publish'))
+
+    def published(self):
+        return [(event, data) for _, event, data in (call.args for call in self.publish.call_args_list)]
+
+    def test_transaction_writes_publish_deltas(self):
+        with self.captureOnCommitCallbacks(using='shard1', execute=True):
+            groceries = add_transaction(self.user, self.food, 20)
+        with self.captureOnCommitCallbacks(using='shard1', execute=True):
+            groceries.amount = 25
+            groceries.save()
+
+        (_, added), (_, edited) = self.published()
+        self.assertEqual(edited['version'], get_change_stamp(self.user).version)
+        self.assertEqual(edited['version'], added['version'] + 1)
+        self.assertIsNone(added['previous'])
+        self.assertEqual((edited['previous']['amount'], edited['transaction']['amount']), (20, 25))
+        self.assertEqual(edited['projected'], {self.food.pk: mock.ANY})
+
+    def test_bulk_writes_ask_for_a_snapshot(self):
+        add_transaction(self.user, self.food, 20)
+        self.client.login(username='alice', password=PASSWORD)
+
+        with self.captureOnCommitCallbacks(using='shard1', execute=True):
+            self.client.post('/transactions/bulk/', {'action': 'set_type', 'new_type': 'income', 'scope': 'filter'})
+
+        self.assertEqual(self.published(), [('resync', {})])
+        self.assertEqual(user_rows(Transaction, self.user.pk, 'shard1').get().type, 'income')
+
+    def test_goals_for_other_months_leave_the_dashboard(self):
+        today = timezone.localdate()
+        with self.captureOnCommitCallbacks(using='shard1', execute=True):
+            goal = BudgetGoal.objects.shard(self.user).create(
+                user=self.user, category=self.food, amount=300, month=today.month, year=today.year,
+            )
+        with self.captureOnCommitCallbacks(using='shard1', execute=True):
+            goal.year += 1
+            goal.save()
+
+        (_, shown), (_, moved) = self.published()
+        self.assertEqual((shown['goal']['category'], shown['goal']['amount']), ('Food', 300))
+        self.assertEqual((moved['id'], moved['goal']), (goal.pk, None))
+
+
+class ShardUpgradeTests(ShardedTestCase):
+    def legacy_user(self, username):
+        # A user from before shards were configured: rows on default, no assignment.
+        user = User.objects.create_user(username, password=PASSWORD)
+        Category.objects.using('default').create(user_id=user.pk, name='Food', type='expense')
+        return user
+
+    def test_migration_pins_existing_users_to_default(self):
+        users = [self.legacy_user(f'legacy{n}') for n in range(3)]
+        migration = import_module('budget_planner.migrations.0010_assign_existing_users')
+
+        migration.assign_existing_users(django_apps, SimpleNamespace(connection=connections['shard1']))
+        self.assertFalse(ShardAssignment.objects.exists())
+        migration.assign_existing_users(django_apps, SimpleNamespace(connection=connections['default']))
+
+        self.assertEqual(
+            set(ShardAssignment.objects.values_list('user_id', 'shard')), {(user.pk, 'default') for user in users}
+        )
+
+    def test_unassigned_users_with_rows_on_default_stay_there(self):
+        users = [self.legacy_user(f'legacy{n}') for n in range(3)]
+        newcomer = User.objects.create_user('newcomer')
+
+        self.assertEqual([shard_for_user(user.pk) for user in users], ['default'] * 3)
+        self.assertNotEqual(shard_for_user(newcomer.pk), 'default')
+        for user in users:
+            self.assertEqual(Category.objects.for_user(user).count(), 1)
+            Category.objects.for_user(user).update(name='Groceries')
+
+
+class BatchedTombstoneTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.client.login(username='alice', password=PASSWORD)
+
+    def test_bulk_delete_writes_tombstones_in_one_batch(self):
+        payee = resolve_payee(self.user, 'Market')
+        Transaction.objects.shard(self.user).bulk_create([
+            Transaction(user=self.user, category=self.food, type='expense', amount=n, payee=payee)
+            for n in range(1, 201)
+        ])
+        ids = list(user_rows(Transaction, self.user.pk, 'shard1').values_list('pk', flat=True))
+        version = get_change_stamp(self.user).version
+
+        with CaptureQueriesContext(connections['shard1']) as queries:
+            self.client.post('/transactions/bulk/', {'action': 'delete', 'ids': ids})
+
+        self.assertLess(len(queries), 10)
+        tombstones = user_rows(Tombstone, self.user.pk, 'shard1')
+        self.assertEqual(set(tombstones.values_list('object_id', flat=True)), set(ids))
+        # One sequence for the whole delete.
+        self.assertEqual(set(tombstones.values_list('sequence', flat=True)), {version + 1})
+
+    def test_cascaded_goals_are_tombstoned_with_their_category(self):
+        today = date.today()
+        goals = [
+            BudgetGoal.objects.shard(self.user).create(user=self.user, category=self.food, amount=100, month=month, year=today.year)
+            for month in (1, 2, 3)
+        ]
+        food_pk = self.food.pk
+
+        self.food.delete()
+
+        self.assertEqual(
+            set(user_rows(Tombstone, self.user.pk, 'shard1').values_list('model', 'object_id')),
+            {('category', food_pk)} | {('budget_goal', goal.pk) for goal in goals},
+        )
+
+
+class ConditionalPageTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.client.login(username='alice', password=PASSWORD)
+
+    def etag(self, path='/'):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return response['ETag']
+
+    def test_unchanged_page_is_answered_before_the_view_runs(self):
+        etag = self.etag()
+
+        with mock.patch('budget_planner.views.get_category_registry') as view_work:
+            response = self.client.get('/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        view_work.assert_not_called()
+
+    def test_every_write_changes_the_etag(self):
+        today = date.today()
+        writes = {
+            'add transaction': lambda: self.client.post('/transactions/add/', {
+                'type': 'expense', 'category': self.food.pk, 'amount': '12.50',
+                'description': 'Corner Shop', 'date': today.isoformat(),
+            }),
+            'edit category': lambda: self.client.post(f'/categories/{self.food.pk}/edit/', {
+                'name': 'Groceries', 'type': 'expense', 'icon': 'bi-cart', 'color': 'success',
+            }),
+            'add goal': lambda: self.client.post('/budget-goals/add/', {
+                'category': self.food.pk, 'amount': '300', 'month': today.month, 'year': today.year,
+            }),
+            'delete transaction': lambda: self.client.post(
+                f'/transactions/{user_rows(Transaction, self.user.pk, "shard1").get().pk}/delete/'
+            ),
+            'delete goal': lambda: BudgetGoal.objects.for_user(self.user).get().delete(),
+            'set-based update': lambda: Category.objects.for_user(self.user).update(icon='bi-basket'),
+        }
+        etag = self.etag()
+        for name, write in writes.items():
+            with self.subTest(name):
+                write()
+                self.client.get('/')  # Shows, and so consumes, the write's flash message.
+                new_etag = self.etag()
+                self.assertNotEqual(new_etag, etag)
+                etag = new_etag
+
+    def test_pending_flash_message_forces_a_full_render(self):
+        etag = self.etag('/transactions/')
+        # Refused without writing anything, so the page's data is unchanged.
+        self.client.post('/transactions/bulk/', {'action': 'rename'})
+
+        response = self.client.get('/transactions/', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Unknown bulk action.')
+        self.assertNotIn('ETag', response)
+        response = self.client.get('/transactions/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class BudgetPlanningTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.rent = Category.objects.shard(self.user).create(user=self.user, name='Rent', type='expense')
+        self.client.login(username='alice', password=PASSWORD)
+
+    def goal(self, category, month, year, amount):
+        return BudgetGoal.objects.shard(self.user).create(
+            user=self.user, category=category, amount=amount, month=month, year=year,
+        )
+
+    def goals(self, **filters):
+        return set(
+            user_rows(BudgetGoal, self.user.pk, 'shard1').filter(**filters)
+            .values_list('category__name', 'month', 'year', 'amount')
+        )
+
+    def test_year_copy_is_idempotent(self):
+        self.goal(self.food, 1, 2024, 100)
+        self.goal(self.rent, 2, 2024, 900)
+        self.goal(self.food, 1, 2025, 120)
+
+        self.assertEqual(copy_goals_forward(self.user, 2025), 1)
+        self.assertEqual(copy_goals_forward(self.user, 2025), 0)
+
+        # The existing January goal is kept, not overwritten.
+        self.assertEqual(self.goals(year=2025), {('Food', 1, 2025, 120), ('Rent', 2, 2025, 900)})
+
+    def test_month_copy_wraps_from_december(self):
+        self.goal(self.food, 12, 2024, 100)
+        self.goal(self.rent, 11, 2024, 900)
+
+        response = self.client.post('/budget-goals/copy/', {'year': 2025, 'month': 1})
+
+        self.assertRedirects(response, '/budget-goals/', fetch_redirect_response=False)
+        self.assertEqual(self.goals(year=2025), {('Food', 1, 2025, 100)})
+
+    def test_plan_grid_sets_and_clears_cells(self):
+        self.goal(self.food, 1, 2025, 100)
+        self.goal(self.food, 2, 2025, 200)
+        self.goal(self.rent, 1, 2025, 900)
+
+        self.client.post('/budget-goals/plan/', {
+            'year': 2025,
+            f'goal_{self.food.pk}_1': '150',
+            f'goal_{self.food.pk}_2': '',
+            f'goal_{self.food.pk}_3': '50',
+            f'goal_{self.rent.pk}_1': '900',
+        })
+
+        self.assertEqual(
+            self.goals(year=2025), {('Food', 1, 2025, 150), ('Food', 3, 2025, 50), ('Rent', 1, 2025, 900)}
+        )
+
+    def test_duplicate_goals_are_refused(self):
+        self.goal(self.food, 1, 2025, 100)
+        rent = self.goal(self.rent, 1, 2025, 900)
+        duplicate = {'category': self.food.pk, 'amount': '300', 'month': 1, 'year': 2025}
+
+        added = self.client.post('/budget-goals/add/', duplicate)
+        edited = self.client.post(f'/budget-goals/{rent.pk}/edit/', duplicate)
+
+        for response in [added, edited]:
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'A budget goal for this category and month already exists!')
+        self.assertEqual(self.goals(), {('Food', 1, 2025, 100), ('Rent', 1, 2025, 900)})
+
+
+class CategoryMergeTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.dining = Category.objects.shard(self.user).create(user=self.user, name='Dining', type='expense')
+        self.client.login(username='alice', password=PASSWORD)
+
+    def goal(self, category, month, amount):
+        return BudgetGoal.objects.shard(self.user).create(
+            user=self.user, category=category, amount=amount, month=month, year=2025,
+        )
+
+    def test_merge_moves_rows_and_combines_goals(self):
+        add_transaction(self.user, self.dining, 30)
+        add_transaction(self.user, self.food, 70)
+        self.goal(self.dining, 1, 100)
+        self.goal(self.dining, 2, 40)
+        self.goal(self.food, 1, 250)
+
+        self.client.post('/categories/merge/', {'source': self.dining.pk, 'target': self.food.pk})
+
+        self.assertFalse(user_rows(Category, self.user.pk, 'shard1').filter(pk=self.dining.pk).exists())
+        self.assertEqual(
+            sorted(user_rows(Transaction, self.user.pk, 'shard1').values_list('category_id', 'amount')),
+            [(self.food.pk, Decimal('30.00')), (self.food.pk, Decimal('70.00'))],
+        )
+        self.assertEqual(
+            sorted(user_rows(BudgetGoal, self.user.pk, 'shard1').values_list('category_id', 'month', 'amount')),
+            [(self.food.pk, 1, Decimal('350.00')), (self.food.pk, 2, Decimal('40.00'))],
+        )
+
+    def test_merge_refuses_mismatched_types(self):
+        salary = Category.objects.shard(self.user).create(user=self.user, name='Salary', type='income')
+
+        self.client.post('/categories/merge/', {'source': salary.pk, 'target': self.food.pk})
+
+        self.assertTrue(user_rows(Category, self.user.pk, 'shard1').filter(pk=salary.pk).exists())
+
+
+class BulkTransactionTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.client.login(username='alice', password=PASSWORD)
+
+    def test_shift_date_moves_every_selected_row(self):
+        first = add_transaction(self.user, self.food, 10, day=date(2025, 1, 30))
+        second = add_transaction(self.user, self.food, 20, day=date(2025, 3, 1))
+        untouched = add_transaction(self.user, self.food, 30, day=date(2025, 3, 1))
+
+        self.client.post('/transactions/bulk/', {
+            'action': 'shift_date', 'days': '3', 'ids': [first.pk, second.pk],
+        })
+
+        dates = dict(user_rows(Transaction, self.user.pk, 'shard1').values_list('pk', 'date'))
+        self.assertEqual(dates, {
+            first.pk: date(2025, 2, 2), second.pk: date(2025, 3, 4), untouched.pk: date(2025, 3, 1),
+        })
+
+    def test_ids_scope_ignores_other_users_rows(self):
+        bob = make_user('bob', 'shard1')
+        bob_food = Category.objects.shard(bob).create(user=bob, name='Food', type='expense')
+        theirs = add_transaction(bob, bob_food, 50)
+        mine = add_transaction(self.user, self.food, 10)
+
+        self.client.post('/transactions/bulk/', {'action': 'delete', 'ids': [mine.pk, theirs.pk]})
+
+        self.assertFalse(user_rows(Transaction, self.user.pk, 'shard1').exists())
+        self.assertTrue(user_rows(Transaction, bob.pk, 'shard1').filter(pk=theirs.pk).exists())
+
+
+class CategoryRegistryTests(TransactionTestCase):
+    # Registries read inside a transaction are never cached, so no TestCase here.
+    databases = '__all__'
+
+    def setUp(self):
+        cache.clear()
+        self.user = make_user('alice', 'shard1')
+        self.food = Category.objects.shard(self.user).create(user=self.user, name='Food', type='expense')
+        self.salary = Category.objects.shard(self.user).create(user=self.user, name='Salary', type='income')
+
+    def test_forms_render_from_warm_cache(self):
+        get_category_registry(self.user)
+        table = Category._meta.db_table
+
+        with CaptureQueriesContext(connections['shard1']) as queries:
+            TransactionForm(self.user).as_p()
+            BudgetGoalForm(self.user).as_p()
+
+        self.assertFalse([query['sql'] for query in queries if table in query['sql']])
+
+    def test_category_writes_refresh_registry(self):
+        get_category_registry(self.user)
+
+        rent = Category.objects.shard(self.user).create(user=self.user, name='Rent', type='expense')
+        self.assertEqual(get_category_registry(self.user).get(rent.pk), rent)
+
+        self.food.delete()
+        self.assertIsNone(get_category_registry(self.user).get(self.food.pk))
+
+    def test_forms_refuse_foreign_and_mistyped_categories(self):
+        bob = make_user('bob', 'shard1')
+        theirs = Category.objects.shard(bob).create(user=bob, name='Food', type='expense')
+        goal = {'amount': '100', 'month': 1, 'year': 2025}
+        transaction = {'type': 'expense', 'amount': '10', 'description': 'Lunch', 'date': '2025-01-02'}
+
+        for category in [theirs.pk, self.salary.pk, 'food']:
+            with self.subTest(category=category):
+                form = BudgetGoalForm(self.user, {**goal, 'category': category})
+                self.assertIn('category', form.errors)
+        self.assertTrue(BudgetGoalForm(self.user, {**goal, 'category': self.food.pk}).is_valid())
+
+        form = TransactionForm(self.user, {**transaction, 'category': theirs.pk})
+        self.assertIn('category', form.errors)
+
+
+class StructuredLoggingTests(ShardedTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stream = io.StringIO()
+        target = logging.StreamHandler(self.stream)
+        target.setFormatter(JSONFormatter())
+        self.handler = queue_listener_handler([target])
+        self.handler.addFilter(RequestContextFilter())
+        self.addCleanup(self.handler.close)
+        patcher = mock.patch.object(logging.getLogger('budget_planner'), 'handlers', [self.handler])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def entries(self):
+        # Closing stops the listener once the queue is drained.
+        self.handler.close()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    @override_settings(EMAIL_HOST_PASSWORD='your-app-password-here')
+    def test_request_records_carry_request_and_user_ids(self):
+        user = make_user('alice', 'shard1')
+        self.client.login(username='alice', password=PASSWORD)
+
+        self.client.post(
+            '/contact/', {'name': 'Alice', 'email': 'alice@example.com', 'subject': 'Hi', 'message': 'Hello'},
+            HTTP_X_REQUEST_ID='req-42',
+        )
+
+        [entry] = self.entries()
+        self.assertEqual(
+            (entry['logger'], entry['level'], entry['request_id'], entry['user_id']),
+            ('budget_planner.views', 'ERROR', 'req-42', user.pk),
+        )
+
+    def test_tracebacks_survive_the_queue(self):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logging.getLogger('budget_planner.views').exception('Failed for %s', 'alice')
+
+        [entry] = self.entries()
+        self.assertEqual((entry['message'], entry['request_id']), ('Failed for alice', None))
+        self.assertIn('Traceback', entry['exc_info'])
+        self.assertIn('ZeroDivisionError: division by zero', entry['exc_info'])
+
+    def test_prepare_resolves_the_traceback(self):
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            record = logging.makeLogRecord({'msg': 'Failed for %s', 'args': ('alice',), 'exc_info': sys.exc_info()})
+
+        prepared = self.handler.prepare(record)
+
+        self.assertEqual((prepared.msg, prepared.args, prepared.exc_info), ('Failed for alice', None, None))
+        self.assertIn('ZeroDivisionError: division by zero', prepared.exc_text)
+        # The caller's record is left alone for other handlers.
+        self.assertIsNotNone(record.exc_info)
@@ -5,6 +5,7 @@ from . import views
 urlpatterns = [
     # Authentication
     path('', views.dashboard, name='dashboard'),
+    path('events/dashboard/', views.dashboard_events, name='dashboard_events'),
     path('login/', auth_views.LoginView.as_view(template_name='login.html'), name='login'),
     path('logout/', auth_views.LogoutView.as_view(), name='logout'),
     path('register/', views.register, name='register'),
@@ -12,23 +13,31 @@ urlpatterns = [
     # Transactions
     path('transactions/', views.transactions, name='transactions'),
     path('transactions/add/', views.add_transaction, name='add_transaction'),
+    path('transactions/bulk/', views.bulk_transactions, name='bulk_transactions'),
     path('transactions/<int:pk>/edit/', views.edit_transaction, name='edit_transaction'),
     path('transactions/<int:pk>/delete/', views.delete_transaction, name='delete_transaction'),
     
     # Categories
     path('categories/', views.categories, name='categories'),
     path('categories/add/', views.add_category, name='add_category'),
+    path('categories/merge/', views.merge_category, name='merge_category'),
     path('categories/<int:pk>/edit/', views.edit_category, name='edit_category'),
     path('categories/<int:pk>/delete/', views.delete_category, name='delete_category'),
     
     # Budget Goals
     path('budget-goals/', views.budget_goals, name='budget_goals'),
     path('budget-goals/add/', views.add_budget_goal, name='add_budget_goal'),
+    path('budget-goals/plan/', views.budget_plan, name='budget_plan'),
+    path('budget-goals/copy/', views.copy_budget_goals, name='copy_budget_goals'),
     path('budget-goals/<int:pk>/edit/', views.edit_budget_goal, name='edit_budget_goal'),
     path('budget-goals/<int:pk>/delete/', views.delete_budget_goal, name='delete_budget_goal'),
     
     # Reports
     path('reports/', views.reports, name='reports'),
+    path('reports/custom/', views.custom_report, name='custom_report'),
+    
+    # Offline client sync
+    path('api/sync/', views.sync, name='sync'),
     
     path('about/', views.about, name='about'),
     path('contact/', views.contact, name='contact'),
@@ -1,12 +1,26 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.urls import reverse
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.db.models import Sum
+from django.http import HttpResponse, JsonResponse
+from django.db import IntegrityError
+from django.db.models import Exists, F, OuterRef, Q, Subquery, Sum
+from django.db.transaction import atomic
 from django.utils import timezone
-from datetime import datetime
-from .models import Category, Transaction, BudgetGoal
-from .forms import RegisterForm, CategoryForm, TransactionForm, BudgetGoalForm
+from datetime import date, datetime, timedelta
+import calendar
+from .models import Category, Payee, Transaction, BudgetGoal
+from .forms import RegisterForm, CategoryForm, TransactionForm, BudgetGoalForm, BudgetPlanForm, ReportRangeForm
+from .analytics import cents_to_decimal, get_user_frame, month_index, month_start
+from .forecasting import forecasts_for
+from .payees import matching_payees
+from .planning import copy_goals_forward, save_goals
+from .registry import get_category_registry
+from .sharding import shard_for_user
+from .signals import bulk_changed
+from .stamps import conditional_page
+from .sync import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursor, changes_since
 import json
 from django.core.mail import send_mail
 from django.conf import settings
@@ -32,7 +46,7 @@ def register(request):
                 {'name': 'Healthcare', 'type': 'expense', 'icon': 'bi-heart-pulse', 'color': 'danger'},
             ]
             for cat in default_categories:
-                Category.objects.create(user=user, **cat)
+                Category.objects.shard(user).create(user=user, **cat)
             
             login(request, user)
             messages.success(request, 'Account created successfully!')
@@ -43,35 +57,44 @@ def register(request):
 
 
 @login_required
+@conditional_page
 def dashboard(request):
     today = timezone.now()
     current_month = today.month
     current_year = today.year
     
     # Get monthly totals
-    monthly_income = Transaction.objects.filter(
-        user=request.user, type='income',
+    monthly_income = Transaction.objects.for_user(request.user).filter(
+        type='income',
         date__month=current_month, date__year=current_year
     ).aggregate(total=Sum('amount'))['total'] or 0
     
-    monthly_expense = Transaction.objects.filter(
-        user=request.user, type='expense',
+    monthly_expense = Transaction.objects.for_user(request.user).filter(
+        type='expense',
         date__month=current_month, date__year=current_year
     ).aggregate(total=Sum('amount'))['total'] or 0
     
     balance = monthly_income - monthly_expense
     
+    registry = get_category_registry(request.user)
+
     # Recent transactions
-    recent_transactions = Transaction.objects.filter(user=request.user)[:5]
+    recent_transactions = registry.attach(list(
+        Transaction.objects.for_user(request.user).select_related('payee')[:5]
+    ))
     
-    # Budget goals progress
-    budget_goals = BudgetGoal.objects.filter(
-        user=request.user, month=current_month, year=current_year
-    )
+    # Budget goals progress with projected end-of-month spend
+    budget_goals = list(BudgetGoal.objects.for_user(request.user).filter(
+        month=current_month, year=current_year
+    ))
+    registry.attach(budget_goals)
+    forecasts = forecasts_for(request.user, current_month, current_year)
+    for goal in budget_goals:
+        goal.forecast = forecasts.get(goal.category_id)
     
     # Expense by category for chart
-    expense_by_category = Transaction.objects.filter(
-        user=request.user, type='expense',
+    expense_by_category = Transaction.objects.for_user(request.user).filter(
+        type='expense',
         date__month=current_month, date__year=current_year
     ).values('category__name').annotate(total=Sum('amount')).order_by('-total')
     
@@ -84,13 +107,13 @@ def dashboard(request):
             month += 12
             year -= 1
         
-        income = Transaction.objects.filter(
-            user=request.user, type='income',
+        income = Transaction.objects.for_user(request.user).filter(
+            type='income',
             date__month=month, date__year=year
         ).aggregate(total=Sum('amount'))['total'] or 0
         
-        expense = Transaction.objects.filter(
-            user=request.user, type='expense',
+        expense = Transaction.objects.for_user(request.user).filter(
+            type='expense',
             date__month=month, date__year=year
         ).aggregate(total=Sum('amount'))['total'] or 0
         
@@ -115,26 +138,52 @@ def dashboard(request):
 
 
 @login_required
-def transactions(request):
-    transaction_list = Transaction.objects.filter(user=request.user)
+def dashboard_events(request):
+    """Dashboard event stream when not running under ASGI.
+
+    ``live.EventStreamApp`` answers this URL before it reaches Django; a 204
+    tells the browser's EventSource to stop reconnecting.
+    """
+    return HttpResponse(status=204)
+
+
+def filter_transactions(user, params):
+    transaction_list = Transaction.objects.for_user(user)
     
     # Filter by type
-    trans_type = request.GET.get('type')
+    trans_type = params.get('type')
     if trans_type in ['income', 'expense']:
         transaction_list = transaction_list.filter(type=trans_type)
     
     # Filter by category
-    category_id = request.GET.get('category')
-    if category_id:
+    category_id = params.get('category')
+    if category_id and category_id.isdigit():
         transaction_list = transaction_list.filter(category_id=category_id)
     
-    categories = Category.objects.filter(user=request.user)
+    # Search by payee
+    query = params.get('q', '').strip()
+    if query:
+        transaction_list = transaction_list.filter(payee__in=matching_payees(user, query))
+    
+    return transaction_list
+
+
+@login_required
+@conditional_page
+def transactions(request):
+    transaction_list = filter_transactions(request.user, request.GET).select_related('payee')
+    trans_type = request.GET.get('type')
+    category_id = request.GET.get('category')
+    query = request.GET.get('q', '')
+    
+    registry = get_category_registry(request.user)
     
     context = {
-        'transactions': transaction_list,
-        'categories': categories,
+        'transactions': registry.attach(list(transaction_list)),
+        'categories': registry.categories,
         'selected_type': trans_type,
         'selected_category': category_id,
+        'query': query,
     }
     return render(request, 'transactions.html', context)
 
@@ -144,9 +193,7 @@ def add_transaction(request):
     if request.method == 'POST':
         form = TransactionForm(request.user, request.POST)
         if form.is_valid():
-            transaction = form.save(commit=False)
-            transaction.user = request.user
-            transaction.save()
+            form.save()
             messages.success(request, 'Transaction added successfully!')
             return redirect('transactions')
     else:
@@ -157,7 +204,7 @@ def add_transaction(request):
 
 @login_required
 def edit_transaction(request, pk):
-    transaction = get_object_or_404(Transaction, pk=pk, user=request.user)
+    transaction = get_object_or_404(Transaction.objects.for_user(request.user), pk=pk)
     if request.method == 'POST':
         form = TransactionForm(request.user, request.POST, instance=transaction)
         if form.is_valid():
@@ -172,7 +219,7 @@ def edit_transaction(request, pk):
 
 @login_required
 def delete_transaction(request, pk):
-    transaction = get_object_or_404(Transaction, pk=pk, user=request.user)
+    transaction = get_object_or_404(Transaction.objects.for_user(request.user), pk=pk)
     if request.method == 'POST':
         transaction.delete()
         messages.success(request, 'Transaction deleted successfully!')
@@ -180,9 +227,68 @@ def delete_transaction(request, pk):
 
 
 @login_required
+def bulk_transactions(request):
+    """Apply one action to many transactions with a single UPDATE or DELETE.
+
+    Rows are picked either by the checked ``ids`` or, with ``scope=filter``,
+    by the same type/category filter the list page uses.
+    """
+    if request.method != 'POST':
+        return redirect('transactions')
+
+    if request.POST.get('scope') == 'filter':
+        selected = filter_transactions(request.user, request.POST)
+    else:
+        ids = [pk for pk in request.POST.getlist('ids') if pk.isdigit()]
+        selected = Transaction.objects.for_user(request.user).filter(pk__in=ids)
+
+    action = request.POST.get('action')
+    if action == 'delete':
+        count, _ = selected.delete()
+        messages.success(request, f'{count} transaction(s) deleted.')
+        return redirect('transactions')
+
+    if action == 'set_category':
+        category_id = request.POST.get('category_id', '')
+        category = get_category_registry(request.user).get(int(category_id)) if category_id.isdigit() else None
+        if category is None:
+            messages.error(request, 'Please choose a category.')
+            return redirect('transactions')
+        count = selected.update(category=category, updated_at=timezone.now())
+    elif action == 'set_type':
+        trans_type = request.POST.get('new_type')
+        if trans_type not in ['income', 'expense']:
+            messages.error(request, 'Please choose a type.')
+            return redirect('transactions')
+        count = selected.update(type=trans_type, updated_at=timezone.now())
+    elif action == 'shift_date':
+        try:
+            days = int(request.POST.get('days', ''))
+        except ValueError:
+            days = 0
+        if not days or abs(days) > 3650:
+            messages.error(request, 'Please enter a number of days to shift by.')
+            return redirect('transactions')
+        count = selected.update(date=F('date') + timedelta(days=days), updated_at=timezone.now())
+    else:
+        messages.error(request, 'Unknown bulk action.')
+        return redirect('transactions')
+
+    # update() bypasses model signals, so refresh derived data here.
+    bulk_changed(request.user)
+    messages.success(request, f'{count} transaction(s) updated.')
+    return redirect('transactions')
+
+
+@login_required
+@conditional_page
 def categories(request):
-    category_list = Category.objects.filter(user=request.user)
-    return render(request, 'categories.html', {'categories': category_list})
+    registry = get_category_registry(request.user)
+    return render(request, 'categories.html', {
+        'categories': registry.categories,
+        'income_categories': registry.income,
+        'expense_categories': registry.expense,
+    })
 
 
 @login_required
@@ -203,7 +309,7 @@ def add_category(request):
 
 @login_required
 def edit_category(request, pk):
-    category = get_object_or_404(Category, pk=pk, user=request.user)
+    category = get_object_or_404(Category.objects.for_user(request.user), pk=pk)
     if request.method == 'POST':
         form = CategoryForm(request.POST, instance=category)
         if form.is_valid():
@@ -218,7 +324,7 @@ def edit_category(request, pk):
 
 @login_required
 def delete_category(request, pk):
-    category = get_object_or_404(Category, pk=pk, user=request.user)
+    category = get_object_or_404(Category.objects.for_user(request.user), pk=pk)
     if request.method == 'POST':
         category.delete()
         messages.success(request, 'Category deleted successfully!')
@@ -226,12 +332,60 @@ def delete_category(request, pk):
 
 
 @login_required
+def merge_category(request):
+    """Move every transaction and budget goal from one category into another."""
+    if request.method != 'POST':
+        return redirect('categories')
+
+    registry = get_category_registry(request.user)
+    source_id = request.POST.get('source', '')
+    target_id = request.POST.get('target', '')
+    source = registry.get(int(source_id)) if source_id.isdigit() else None
+    target = registry.get(int(target_id)) if target_id.isdigit() else None
+    if source is None or target is None or source == target or source.type != target.type:
+        messages.error(request, 'Categories can only be merged into a different category of the same type.')
+        return redirect('categories')
+
+    now = timezone.now()
+    with atomic(using=shard_for_user(request.user)):
+        moved = Transaction.objects.for_user(request.user).filter(category=source).update(
+            category=target, updated_at=now
+        )
+
+        # A month with a goal in both categories keeps one goal with the combined amount.
+        source_goal = BudgetGoal.objects.for_user(request.user).filter(
+            category=source, month=OuterRef('month'), year=OuterRef('year')
+        )
+        target_goal = BudgetGoal.objects.for_user(request.user).filter(
+            category=target, month=OuterRef('month'), year=OuterRef('year')
+        )
+        BudgetGoal.objects.for_user(request.user).filter(category=target).filter(Exists(source_goal)).update(
+            amount=F('amount') + Subquery(source_goal.values('amount')[:1]), updated_at=now
+        )
+        BudgetGoal.objects.for_user(request.user).filter(category=source).filter(Exists(target_goal)).delete()
+        BudgetGoal.objects.for_user(request.user).filter(category=source).update(category=target, updated_at=now)
+
+        source.delete()
+
+    bulk_changed(request.user)
+    messages.success(request, f'Merged {source.name} into {target.name} ({moved} transaction(s) moved).')
+    return redirect('categories')
+
+
+@login_required
+@conditional_page
 def budget_goals(request):
     today = timezone.now()
-    goals = BudgetGoal.objects.filter(user=request.user, month=today.month, year=today.year)
+    goals = list(BudgetGoal.objects.for_user(request.user).filter(month=today.month, year=today.year))
+    get_category_registry(request.user).attach(goals)
+    forecasts = forecasts_for(request.user, today.month, today.year)
+    for goal in goals:
+        goal.forecast = forecasts.get(goal.category_id)
     return render(request, 'budget_goal.html', {
         'goals': goals,
-        'current_month': today.strftime('%B %Y')
+        'current_month': today.strftime('%B %Y'),
+        'month': today.month,
+        'year': today.year,
     })
 
 
@@ -242,17 +396,13 @@ def add_budget_goal(request):
         if form.is_valid():
             goal = form.save(commit=False)
             goal.user = request.user
-            # Check if goal already exists
-            existing = BudgetGoal.objects.filter(
-                user=request.user,
-                category=goal.category,
-                month=goal.month,
-                year=goal.year
-            ).first()
-            if existing:
+            # The unique constraint, not a prior lookup, rejects duplicates.
+            try:
+                with atomic(using=shard_for_user(request.user)):
+                    goal.save()
+            except IntegrityError:
                 messages.error(request, 'A budget goal for this category and month already exists!')
             else:
-                goal.save()
                 messages.success(request, 'Budget goal added successfully!')
                 return redirect('budget_goals')
     else:
@@ -262,15 +412,86 @@ def add_budget_goal(request):
     return render(request, 'budget_goal_form.html', {'form': form, 'title': 'Add Budget Goal'})
 
 
+@login_required
+@conditional_page
+def budget_plan(request):
+    """Edit every expense category's goals for a whole year in one grid."""
+    today = timezone.now()
+    try:
+        year = int(request.POST.get('year') or request.GET.get('year') or today.year)
+    except ValueError:
+        year = today.year
+    categories = get_category_registry(request.user).expense
+    goals = list(BudgetGoal.objects.for_user(request.user).filter(year=year))
+
+    if request.method == 'POST':
+        form = BudgetPlanForm(categories, goals, request.POST)
+        if form.is_valid():
+            amounts, cleared = form.changes()
+            with atomic(using=shard_for_user(request.user)):
+                if amounts:
+                    save_goals(request.user, year, amounts)
+                if cleared:
+                    cells = Q()
+                    for category_id, month in cleared:
+                        cells |= Q(category_id=category_id, month=month)
+                    BudgetGoal.objects.for_user(request.user).filter(cells, year=year).delete()
+            if amounts or cleared:
+                bulk_changed(request.user)
+            messages.success(request, f'Budget plan for {year} saved ({len(amounts)} set, {len(cleared)} cleared).')
+            return redirect(f"{reverse('budget_plan')}?year={year}")
+    else:
+        form = BudgetPlanForm(categories, goals)
+
+    return render(request, 'budget_plan.html', {
+        'form': form,
+        'year': year,
+        'years': range(2020, today.year + 2),
+        'months': list(calendar.month_abbr)[1:],
+    })
+
+
+@login_required
+def copy_budget_goals(request):
+    """Copy last month's goals into this month, or last year's into a year."""
+    if request.method != 'POST':
+        return redirect('budget_goals')
+
+    today = timezone.now()
+    try:
+        year = int(request.POST.get('year', today.year))
+        month = int(request.POST['month']) if request.POST.get('month') else None
+    except ValueError:
+        messages.error(request, 'Please choose a valid period.')
+        return redirect('budget_goals')
+    if month is not None and not 1 <= month <= 12:
+        messages.error(request, 'Please choose a valid period.')
+        return redirect('budget_goals')
+
+    copied = copy_goals_forward(request.user, year, month)
+    if copied:
+        bulk_changed(request.user)
+    if month is None:
+        messages.success(request, f'Copied {copied} goal(s) from {year - 1} into {year}.')
+        return redirect(f"{reverse('budget_plan')}?year={year}")
+    messages.success(request, f'Copied {copied} goal(s) from last month.')
+    return redirect('budget_goals')
+
+
 @login_required
 def edit_budget_goal(request, pk):
-    goal = get_object_or_404(BudgetGoal, pk=pk, user=request.user)
+    goal = get_object_or_404(BudgetGoal.objects.for_user(request.user), pk=pk)
     if request.method == 'POST':
         form = BudgetGoalForm(request.user, request.POST, instance=goal)
         if form.is_valid():
-            form.save()
-            messages.success(request, 'Budget goal updated successfully!')
-            return redirect('budget_goals')
+            try:
+                with atomic(using=shard_for_user(request.user)):
+                    form.save()
+            except IntegrityError:
+                messages.error(request, 'A budget goal for this category and month already exists!')
+            else:
+                messages.success(request, 'Budget goal updated successfully!')
+                return redirect('budget_goals')
     else:
         form = BudgetGoalForm(request.user, instance=goal)
     
@@ -279,7 +500,7 @@ def edit_budget_goal(request, pk):
 
 @login_required
 def delete_budget_goal(request, pk):
-    goal = get_object_or_404(BudgetGoal, pk=pk, user=request.user)
+    goal = get_object_or_404(BudgetGoal.objects.for_user(request.user), pk=pk)
     if request.method == 'POST':
         goal.delete()
         messages.success(request, 'Budget goal deleted successfully!')
@@ -287,55 +508,50 @@ def delete_budget_goal(request, pk):
 
 
 @login_required
+@conditional_page
 def reports(request):
     today = timezone.now()
     year = int(request.GET.get('year', today.year))
+    frame = get_user_frame(request.user)
+    in_year = frame.mask(year=year)
     
     # Yearly summary
-    yearly_income = Transaction.objects.filter(
-        user=request.user, type='income', date__year=year
-    ).aggregate(total=Sum('amount'))['total'] or 0
-    
-    yearly_expense = Transaction.objects.filter(
-        user=request.user, type='expense', date__year=year
-    ).aggregate(total=Sum('amount'))['total'] or 0
+    yearly_income = cents_to_decimal(frame.total(in_year, 'income'))
+    yearly_expense = cents_to_decimal(frame.total(in_year, 'expense'))
     
     # Monthly breakdown
+    income_by_month = dict(zip(*frame.group_by('month', in_year, 'income')))
+    expense_by_month = dict(zip(*frame.group_by('month', in_year, 'expense')))
     monthly_breakdown = []
     for month in range(1, 13):
-        income = Transaction.objects.filter(
-            user=request.user, type='income',
-            date__month=month, date__year=year
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
-        expense = Transaction.objects.filter(
-            user=request.user, type='expense',
-            date__month=month, date__year=year
-        ).aggregate(total=Sum('amount'))['total'] or 0
-        
+        income = int(income_by_month.get(month_index(year, month), 0))
+        expense = int(expense_by_month.get(month_index(year, month), 0))
         monthly_breakdown.append({
             'month': datetime(year, month, 1).strftime('%B'),
-            'income': float(income),
-            'expense': float(expense),
-            'savings': float(income - expense)
+            'income': income / 100,
+            'expense': expense / 100,
+            'savings': (income - expense) / 100
         })
     
     # Category breakdown
-    category_breakdown = Transaction.objects.filter(
-        user=request.user, type='expense', date__year=year
-    ).values('category__name', 'category__color').annotate(
-        total=Sum('amount')
-    ).order_by('-total')
-
-    # Convert Decimal objects to floats for JSON serialization
+    registry = get_category_registry(request.user)
     category_breakdown_list = []
-    for item in category_breakdown:
+    for category_id, total in zip(*frame.group_by('category', frame.mask(type='expense', year=year))):
+        category = registry.get(int(category_id))
         category_breakdown_list.append({
-            'category__name': item['category__name'],
-            'category__color': item['category__color'],
-            'total': float(item['total']) if item['total'] else 0.0
+            'category__name': category.name if category else None,
+            'category__color': category.color if category else None,
+            'total': int(total) / 100
         })
 
+    # Payee breakdown
+    payee_ids, payee_totals = frame.group_by('payee', frame.mask(type='expense', year=year))
+    payee_names = Payee.objects.for_user(request.user).in_bulk([int(pk) for pk in payee_ids[:10]])
+    payee_breakdown = [
+        {'payee': payee_names[int(pk)].name, 'total': int(total) / 100}
+        for pk, total in zip(payee_ids[:10], payee_totals[:10])
+    ]
+
     context = {
         'year': year,
         'years': range(2020, today.year + 2),
@@ -346,10 +562,98 @@ def reports(request):
         'monthly_breakdown_json': json.dumps(monthly_breakdown),
         'category_breakdown': category_breakdown_list,
         'category_breakdown_json': json.dumps(category_breakdown_list),
+        'payee_breakdown': payee_breakdown,
     }
     return render(request, 'reports.html', context)
 
 
+def _year_earlier(day):
+    try:
+        return day.replace(year=day.year - 1)
+    except ValueError:
+        return day.replace(year=day.year - 1, day=28)
+
+
+@login_required
+@conditional_page
+def custom_report(request):
+    """Category x month pivot, year-over-year comparison and rolling spend for any date range."""
+    form = ReportRangeForm(request.GET)
+    if not form.is_valid():
+        return render(request, 'custom_report.html', {'form': form}, status=400)
+    start, end, window = form.cleaned_data['start'], form.cleaned_data['end'], form.cleaned_data['window']
+
+    frame = get_user_frame(request.user)
+    registry = get_category_registry(request.user)
+    in_range = frame.mask(start=start, end=end)
+    prev_start, prev_end = _year_earlier(start), _year_earlier(end)
+    in_prev_range = frame.mask(start=prev_start, end=prev_end)
+
+    summary = []
+    for label, measure in [('Income', 'income'), ('Expenses', 'expense'), ('Net', 'net')]:
+        current = frame.total(in_range, measure)
+        previous = frame.total(in_prev_range, measure)
+        summary.append({
+            'label': label,
+            'current': cents_to_decimal(current),
+            'previous': cents_to_decimal(previous),
+            'change': round((current - previous) / abs(previous) * 100, 1) if previous else None,
+        })
+
+    # Category x month pivot of expenses, every month in the range shown
+    months = list(range(month_index(start.year, start.month), month_index(end.year, end.month) + 1))
+    categories, pivot_months, matrix = frame.pivot('category', 'month', in_range & frame.expense)
+    column = {int(m): i for i, m in enumerate(pivot_months)}
+    previous_totals = dict(zip(*frame.group_by('category', in_prev_range & frame.expense)))
+    pivot_rows = []
+    for category_id, row in zip(categories, matrix):
+        category = registry.get(int(category_id))
+        total = int(row.sum())
+        previous = int(previous_totals.get(category_id, 0))
+        pivot_rows.append({
+            'name': category.name if category else 'Uncategorized',
+            'cells': [cents_to_decimal(row[column[m]]) if m in column else 0 for m in months],
+            'total': cents_to_decimal(total),
+            'previous': cents_to_decimal(previous),
+            'change': round((total - previous) / previous * 100, 1) if previous else None,
+        })
+    pivot_rows.sort(key=lambda r: r['total'], reverse=True)
+
+    daily, trailing = frame.rolling(start, end, window, frame.expense)
+    rolling_data = {
+        'labels': [date.fromordinal(start.toordinal() + i).isoformat() for i in range(len(daily))],
+        'daily': (daily / 100).tolist(),
+        'trailing': (trailing / 100).tolist(),
+    }
+
+    context = {
+        'form': form,
+        'start': start,
+        'end': end,
+        'prev_start': prev_start,
+        'prev_end': prev_end,
+        'window': window,
+        'summary': summary,
+        'months': [month_start(m).strftime('%b %Y') for m in months],
+        'pivot_rows': pivot_rows,
+        'rolling_json': json.dumps(rolling_data),
+    }
+    return render(request, 'custom_report.html', context)
+
+
+@login_required
+def sync(request):
+    """Return the user's transactions, categories and goals changed since ``cursor``."""
+    try:
+        limit = min(max(int(request.GET.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'error': 'limit must be a whole number'}, status=400)
+    try:
+        return JsonResponse(changes_since(request.user, request.GET.get('cursor'), limit))
+    except InvalidCursor as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
 def about(request):
     """Display the About page"""
     return render(request, 'about.html')
@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 application = get_asgi_application()
+
+# Imported once the app registry is ready; serves the dashboard event stream.
+from budget_planner.live import EventStreamApp  # noqa: E402
+
+application = EventStreamApp(application)
@@ -34,6 +34,9 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'budget_planner.middleware.RequestContextMiddleware',
+    'budget_planner.profiling.ProfilingMiddleware',
+    'budget_planner.middleware.ShardMoveMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -65,6 +68,31 @@ DATABASES = {
     }
 }
 
+# Extra databases holding users' budget data next to 'default' (see
+# budget_planner/sharding.py), as a comma-separated list of database URLs.
+# For local testing with SQLite files next to db.sqlite3:
+#   DB_SHARDS=sqlite:///shard1.sqlite3,sqlite:///shard2.sqlite3
+# then create their tables with `python manage.py migrate_shards`.
+# The test suite runs with config/test_settings.py, which adds two shards.
+shard_urls = env.list('DB_SHARDS', default=[])
+for number, url in enumerate(shard_urls, start=1):
+    shard = env.db_url_config(url)
+    if shard['ENGINE'] == 'django.db.backends.sqlite3' and not os.path.isabs(shard['NAME']):
+        shard['NAME'] = BASE_DIR / shard['NAME']
+    DATABASES[f'shard{number}'] = shard
+
+DATABASE_SHARDS = list(DATABASES)
+DATABASE_ROUTERS = ['budget_planner.sharding.UserShardRouter']
+
+# Cache used for per-user lookups such as the category registry. Entries are
+# keyed so that no worker can serve a stale one; a shared backend (Redis,
+# Memcached) only saves each worker from loading its own copy.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -82,6 +110,13 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Request profiling: staff send an X-Profile header or ?_profile=1; a share
+# of all signed-in requests can be sampled too. Profiles are listed at
+# /admin/profiles/ and only the newest PROFILING_KEEP are kept.
+PROFILING_DIR = env('PROFILING_DIR', default=str(BASE_DIR / 'profiles'))
+PROFILING_SAMPLE_RATE = env.float('PROFILING_SAMPLE_RATE', default=0.0)
+PROFILING_KEEP = env.int('PROFILING_KEEP', default=200)
+
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGOUT_REDIRECT_URL = 'login'
 LOGIN_URL = 'login'
@@ -104,21 +139,57 @@ DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL')
 CONTACT_EMAIL_RECIPIENT = env('CONTACT_EMAIL_RECIPIENT')
 
 # Logging configuration
+# Request threads only enqueue records; the 'queue' handler's listener thread
+# writes them as JSON lines to debug.log (and the console). debug.log rotates
+# by size, or on a schedule when LOG_ROTATE_WHEN is set ('midnight', 'H',
+# 'W0', ...: see TimedRotatingFileHandler); LOG_BACKUP_COUNT applies to both.
+LOG_FILE_HANDLER = {
+    'filename': BASE_DIR / 'debug.log',
+    'backupCount': env.int('LOG_BACKUP_COUNT', default=5),
+    'formatter': 'json',
+    'delay': True,
+}
+if env('LOG_ROTATE_WHEN', default=''):
+    LOG_FILE_HANDLER.update({
+        'class': 'logging.handlers.TimedRotatingFileHandler',
+        'when': env('LOG_ROTATE_WHEN'),
+        'utc': True,
+    })
+else:
+    LOG_FILE_HANDLER.update({
+        'class': 'logging.handlers.RotatingFileHandler',
+        'maxBytes': env.int('LOG_MAX_BYTES', default=10 * 1024 * 1024),
+    })
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'filters': {
+        'request_context': {
+            '()': 'budget_planner.log.RequestContextFilter',
+        },
+    },
+    'formatters': {
+        'json': {
+            '()': 'budget_planner.log.JSONFormatter',
+        },
+    },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
+            'formatter': 'json',
         },
-        'file': {
-            'class': 'logging.FileHandler',
-            'filename': BASE_DIR / 'debug.log',
+        'file': LOG_FILE_HANDLER,
+        # Must sort after the handlers it forwards to.
+        'queue': {
+            '()': 'budget_planner.log.queue_listener_handler',
+            'handlers': ['cfg://handlers.console', 'cfg://handlers.file'],
+            'filters': ['request_context'],
         },
     },
     'loggers': {
         'budget_planner': {
-            'handlers': ['console', 'file'],
+            'handlers': ['queue'],
             'level': 'INFO',
         },
     },
@@ -0,0 +1,18 @@
+"""Settings for the test suite:
+
+    python manage.py test --settings=config.test_settings
+
+Sharding is only exercised with more than one database, so unless DB_SHARDS
+already configures shards, two SQLite shards are added (in memory while the
+tests run).
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+if len(DATABASES) == 1:
+    for number in (1, 2):
+        DATABASES[f'shard{number}'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / f'shard{number}.sqlite3',
+        }
+    DATABASE_SHARDS = list(DATABASES)
@@ -1,7 +1,12 @@
 from django.contrib import admin
 from django.urls import path, include
+from budget_planner.admin import profile_detail, profile_download, profile_list
 
 urlpatterns = [
+    # Registered ahead of the admin so its catch-all doesn't swallow them.
+    path('admin/profiles/', admin.site.admin_view(profile_list), name='profile_list'),
+    path('admin/profiles/<str:name>/', admin.site.admin_view(profile_detail), name='profile_detail'),
+    path('admin/profiles/<str:name>/download/', admin.site.admin_view(profile_download), name='profile_download'),
     path('admin/', admin.site.urls),
     path('', include('budget_planner.urls')),
 ]